@@ -0,0 +1,244 @@
+# Synthetic load for the tracker and its commands, with no Discord connection.
+# Fake guilds, members and gateway payloads drive the real event handlers,
+# reconciliation sweeps and command queries against a scratch database seeded
+# with history, once per database size.
+#
+#   python benchmarks/load.py [--guilds 5] [--members 2000] [--sizes 1000,100000,1000000]
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import discord
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HISTORY_DAYS = 90
+SEED_BATCH = 20000
+GAMES = [f"Game {i}" for i in range(40)]
+CHANNELS = 8
+COMMAND_SAMPLES = 200
+
+def percentiles(samples):
+    samples = sorted(samples)
+    return (
+        f"p50 {statistics.median(samples) * 1000:8.2f} ms  "
+        f"p99 {samples[min(int(len(samples) * 0.99), len(samples) - 1)] * 1000:8.2f} ms"
+    )
+
+def user_id(guild, member):
+    return 10 ** 17 + guild * 100000 + member
+
+def channel_id(guild, channel):
+    return 10 ** 16 + guild * 100 + channel
+
+class FakeGuild:
+    def __init__(self, guild_id, members):
+        self.id = guild_id
+        self.shard_id = 0
+        self.name = f"Guild {guild_id}"
+        self.members = members
+        self.channels = {channel_id(guild_id, i): SimpleNamespace(id=channel_id(guild_id, i), name=f"voice-{i}") for i in range(CHANNELS)}
+
+    def get_channel(self, channel_id):
+        return self.channels.get(channel_id)
+
+    async def query_members(self, user_ids, limit, cache):
+        return [SimpleNamespace(id=user_id, name=f"user{user_id}", bot=False, roles=[]) for user_id in user_ids[:limit]]
+
+def seed_history(track, guilds, members, size):
+    # Closed intervals spread over the retention horizon, written the way the
+    # tracker writes them, so rollups and badge counters match the history
+    rng = random.Random(1)
+    now = datetime.utcnow()
+    kinds = [('status', ('online', 'idle', 'dnd', 'offline')), ('game', GAMES), ('voice', None)]
+    written = 0
+    while written < size:
+        batch = min(SEED_BATCH, size - written)
+        rows, closed = {kind: [] for kind, _ in kinds}, []
+        for _ in range(batch):
+            guild, member = rng.randrange(guilds), rng.randrange(members)
+            kind, values = rng.choice(kinds)
+            value = rng.choice(values) if values else str(channel_id(guild, rng.randrange(CHANNELS)))
+            start = now - timedelta(days=HISTORY_DAYS) + timedelta(seconds=rng.randrange(HISTORY_DAYS * 86400 - 7200))
+            end = start + timedelta(seconds=rng.randrange(60, 7200))
+            rows[kind].append((str(guild), str(user_id(guild, member)), value, start, end))
+            closed.append((str(guild), str(user_id(guild, member)), kind, value, start, end))
+
+        session = track.Session()
+        track.resolve_game_ids(session, GAMES)
+        for kind, intervals in rows.items():
+            if intervals:
+                model, column = track.TRACKED_KINDS[kind]
+                track.bulk_insert(session, model.__table__, [
+                    {'guild_id': guild_id, 'user_id': user, column: track.stored_value(kind, value), 'start_time': start, 'end_time': end}
+                    for guild_id, user, value, start, end in intervals
+                ])
+        # Counters expect each user's intervals in order
+        closed.sort(key=lambda interval: (interval[0], interval[1], interval[4]))
+        track.record_closed(session, closed)
+        session.commit()
+        session.close()
+        written += batch
+
+def guild_create(guild, members, rng):
+    presences, voice_states = [], []
+    for member in range(members):
+        status = rng.choice(['online', 'online', 'idle', 'dnd', None])
+        if status:
+            activities = [{'type': 0, 'name': rng.choice(GAMES)}] if rng.random() < 0.3 else []
+            presences.append({'user': {'id': str(user_id(guild, member))}, 'status': status, 'activities': activities})
+        if rng.random() < 0.1:
+            voice_states.append({'user_id': str(user_id(guild, member)), 'channel_id': str(channel_id(guild, rng.randrange(CHANNELS)))})
+    return {'id': str(guild), 'members': [], 'presences': presences, 'voice_states': voice_states}
+
+def presence_payload(guild, member, rng):
+    activities = [SimpleNamespace(type=discord.ActivityType.playing, name=game) for game in rng.sample(GAMES, rng.choice([0, 0, 1, 1, 2]))]
+    return SimpleNamespace(
+        guild_id=guild, user_id=user_id(guild, member),
+        client_status=SimpleNamespace(raw_status=rng.choice(['online', 'idle', 'dnd', 'offline'])), activities=activities
+    )
+
+def voice_update(fake_guild, member, rng):
+    channel = rng.choice([None, *fake_guild.channels.values()])
+    after = SimpleNamespace(
+        channel=channel, self_mute=rng.random() < 0.3, mute=False, self_deaf=rng.random() < 0.1, deaf=False,
+        self_stream=rng.random() < 0.1, self_video=False
+    )
+    return SimpleNamespace(id=user_id(fake_guild.id, member), bot=False, guild=fake_guild), None, after
+
+class Counters:
+    def __init__(self):
+        self.queries = 0
+        self.commits = []
+        self.started = threading.local()
+
+    def install(self, track):
+        def count_query(*args):
+            self.queries += 1
+
+        def begin_commit(session):
+            self.started.time = time.perf_counter()
+
+        def end_commit(session):
+            start = getattr(self.started, 'time', None)
+            if start is not None:
+                self.commits.append(time.perf_counter() - start)
+                self.started.time = None
+
+        track.event.listen(track.engine, 'before_cursor_execute', count_query)
+        track.event.listen(track.Session, 'before_commit', begin_commit)
+        track.event.listen(track.Session, 'after_commit', end_commit)
+
+async def timed_sweep(track, counters):
+    queries = counters.queries
+    start = time.perf_counter()
+    await track.reconcile_activities()
+    await track.flush_writes()
+    return time.perf_counter() - start, counters.queries - queries
+
+async def time_command(compute):
+    samples = []
+    for _ in range(COMMAND_SAMPLES):
+        start = time.perf_counter()
+        await compute()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+async def replay(track, args):
+    rng = random.Random(2)
+    counters = Counters()
+    counters.install(track)
+
+    guilds = [FakeGuild(guild, range(args.members)) for guild in range(args.guilds)]
+    track.shard_guilds = lambda shard_id: guilds
+    track.owned_guild_ids = lambda: [str(guild.id) for guild in guilds]
+    for guild in guilds:
+        track.cache_settings(await track.run_db(track.save_settings, track.ServerSettings(server_id=str(guild.id), track_voice_states=True)))
+        track.seed_member_states(guild_create(guild.id, args.members, rng))
+
+    track.reset_open_intervals(await track.run_db(track.load_open_intervals, track.owned_guild_ids(), write=True))
+    track.index_loaded.set()
+    track.writer_task = asyncio.ensure_future(track.interval_writer())
+
+    seconds, queries = await timed_sweep(track, counters)
+    print(f"  first sweep:  {seconds * 1000:9.1f} ms  {queries:6} queries  {sum(len(v) for v in track.open_intervals.values())} open intervals")
+
+    counters.commits.clear()
+    handled = []
+    for _ in range(args.events):
+        guild = rng.choice(guilds)
+        member = rng.randrange(args.members)
+        start = time.perf_counter()
+        if rng.random() < 0.7:
+            await track.on_raw_presence_update(presence_payload(guild.id, member, rng))
+        else:
+            await track.on_voice_state_update(*voice_update(guild, member, rng))
+        handled.append(time.perf_counter() - start)
+    await track.flush_writes()
+    print(f"  {args.events} events: handler {percentiles(handled)}")
+    print(f"  {len(counters.commits)} batch commits: {percentiles(counters.commits)}")
+
+    seconds, queries = await timed_sweep(track, counters)
+    print(f"  steady sweep: {seconds * 1000:9.1f} ms  {queries:6} queries")
+
+    # Command queries without the short-lived result cache in front of them
+    guild = guilds[0]
+    start = time.perf_counter()
+    await track.guild_insights(str(guild.id))
+    print(f"  insights build: {(time.perf_counter() - start) * 1000:7.1f} ms")
+    user = str(user_id(guild.id, 0))
+    commands = {
+        'status': lambda: track.fetch_totals(str(guild.id), 'status', 7, user),
+        'gametime': lambda: track.fetch_totals(str(guild.id), 'game', 7, user),
+        'voicetime': lambda: track.fetch_totals(str(guild.id), 'voice', 7, user),
+        'leaderboard': lambda: track.leaderboard_fields(guild, 'online', 7, rng.randrange(1, 6)),
+        'channels': lambda: track.channel_leaderboard_fields(guild, 7),
+        'mostplayedgame': lambda: track.most_played_field(guild, 7),
+        'badges': lambda: track.badge_values(str(guild.id), datetime.utcnow()),
+        'insights': lambda: track.insights_fields(guild, 'online'),
+    }
+    for name, compute in commands.items():
+        print(f"  {name:<15} {percentiles(await time_command(compute))}")
+
+    track.writer_task.cancel()
+
+def run(args):
+    os.chdir(tempfile.mkdtemp(prefix='trackman-bench-'))
+    sys.path.insert(0, ROOT)
+    import track
+
+    start = time.perf_counter()
+    seed_history(track, args.guilds, args.members, args.size)
+    print(f"{args.size} intervals, {args.guilds} guilds x {args.members} members (seeded in {time.perf_counter() - start:.1f} s)")
+    asyncio.run(replay(track, args))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--guilds', type=int, default=5)
+    parser.add_argument('--members', type=int, default=2000)
+    parser.add_argument('--events', type=int, default=20000)
+    parser.add_argument('--sizes', default='1000,100000,1000000')
+    parser.add_argument('--size', type=int)
+    args = parser.parse_args()
+
+    if args.size is not None:
+        run(args)
+        return
+
+    # Each size gets a fresh process and database
+    for size in args.sizes.split(','):
+        subprocess.run(
+            [sys.executable, __file__, '--guilds', str(args.guilds), '--members', str(args.members), '--events', str(args.events), '--size', size],
+            check=True
+        )
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+# Memory held per 10k members by discord.py's member cache compared with the
+# tracker's member state store, both built from the same GUILD_CREATE payload.
+#
+#   python benchmarks/member_memory.py [--members 10000] [--games 50]
+import argparse
+import os
+import sys
+import tempfile
+import tracemalloc
+
+import discord
+from discord.state import ConnectionState
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def guild_payload(members, games):
+    users = [str(10 ** 17 + i) for i in range(members)]
+    return {
+        'id': '1',
+        'name': "Benchmark",
+        'member_count': members,
+        'roles': [],
+        'channels': [],
+        'members': [
+            {
+                'user': {'id': user, 'username': f"user{i}", 'global_name': f"User {i}", 'discriminator': '0', 'avatar': None},
+                'roles': [],
+                'joined_at': '2024-01-01T00:00:00+00:00',
+                'deaf': False,
+                'mute': False,
+                'flags': 0
+            }
+            for i, user in enumerate(users)
+        ],
+        'presences': [
+            {
+                'user': {'id': user},
+                'status': ('online', 'idle', 'dnd')[i % 3],
+                'client_status': {'desktop': 'online'},
+                # A separate string per member, as decoded from the gateway
+                'activities': [{'type': 0, 'name': f"Game {i % games}", 'created_at': 0}]
+            }
+            for i, user in enumerate(users)
+        ],
+        'voice_states': [{'user_id': user, 'channel_id': '42'} for user in users[::10]],
+    }
+
+def measure(build):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    kept = build()
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return kept, used
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--members', type=int, default=10000)
+    parser.add_argument('--games', type=int, default=50)
+    args = parser.parse_args()
+
+    os.chdir(tempfile.mkdtemp(prefix='trackman-bench-'))
+    sys.path.insert(0, ROOT)
+    import track
+
+    state = ConnectionState(
+        dispatch=lambda *args: None, handlers={}, hooks={}, http=None, intents=discord.Intents.all(),
+        member_cache_flags=discord.MemberCacheFlags.all(), chunk_guilds_at_startup=False
+    )
+    per = 10000 / args.members
+
+    guild, used = measure(lambda: discord.Guild(data=guild_payload(args.members, args.games), state=state))
+    print(f"discord.py member cache: {len(guild.members):>7} members  {used * per / 2 ** 20:6.2f} MiB per 10k")
+
+    payload = guild_payload(args.members, args.games)
+    _, used = measure(lambda: track.seed_member_states(payload))
+    print(f"member state store:      {len(track.member_states[1]):>7} members  {used * per / 2 ** 20:6.2f} MiB per 10k")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+# Command read latency while the tracker flushes interval batches, once per
+# journal mode. Runs against a scratch database in a temporary directory.
+#
+#   python benchmarks/read_latency.py [--users 5000] [--seconds 10]
+import argparse
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+JOURNAL_MODES = ['DELETE', 'WAL']
+FLUSH_SIZE = 5000
+
+def seed(track, users):
+    now = datetime.utcnow()
+    session = track.Session()
+    totals = {}
+    for user in range(users):
+        for day in range(30):
+            for key in ('online', 'idle', 'dnd'):
+                totals[('1', str(user), 'status', (now - timedelta(days=day)).date(), key)] = random.random() * 3600
+    track.write_rollups(session, totals)
+    session.commit()
+    session.close()
+
+def flush_batches(track, users, stop, flushes):
+    opened = {}
+    now = datetime.utcnow()
+    while not stop.is_set():
+        changes = []
+        for _ in range(FLUSH_SIZE):
+            now += timedelta(milliseconds=10)
+            user = str(random.randrange(users))
+            current = opened.get(user)
+            status = random.choice([status for status in ('online', 'idle', 'dnd') if status != current])
+            changes.append(track.IntervalChange('status', '1', user, now - timedelta(seconds=1) if current else None, current, status, now))
+            opened[user] = status
+
+        session = track.Session()
+        start = time.perf_counter()
+        track.write_interval_batch(session, changes)
+        flushes.append(time.perf_counter() - start)
+        session.close()
+
+def read_latencies(track, users, seconds):
+    since = track.window_start(7, datetime.utcnow()).date()
+    latencies = []
+    deadline = time.perf_counter() + seconds
+
+    def reader():
+        session = track.Session()
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            track.rollup_totals(session, '1', 'status', since, str(random.randrange(users)))
+            session.rollback()
+            latencies.append(time.perf_counter() - start)
+        session.close()
+
+    threads = [threading.Thread(target=reader) for _ in range(track.DB_READ_WORKERS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies
+
+def summary(latencies):
+    latencies = sorted(latencies)
+    return (
+        f"{len(latencies):>7} reads  "
+        f"p50 {statistics.median(latencies) * 1000:7.2f} ms  "
+        f"p99 {latencies[int(len(latencies) * 0.99)] * 1000:7.2f} ms  "
+        f"max {latencies[-1] * 1000:7.2f} ms"
+    )
+
+def run(args):
+    os.chdir(tempfile.mkdtemp(prefix='trackman-bench-'))
+    sys.path.insert(0, ROOT)
+    import track
+
+    seed(track, args.users)
+    print(f"journal_mode={track.SQLITE_JOURNAL_MODE}")
+    print(f"  idle:     {summary(read_latencies(track, args.users, args.seconds))}")
+
+    stop, flushes = threading.Event(), []
+    writer = threading.Thread(target=flush_batches, args=(track, args.users, stop, flushes))
+    writer.start()
+    latencies = read_latencies(track, args.users, args.seconds)
+    stop.set()
+    writer.join()
+    print(f"  flushing: {summary(latencies)}")
+    print(f"  {len(flushes)} flushes of {FLUSH_SIZE} changes, median {statistics.median(flushes) * 1000:.0f} ms")
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=5000)
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--mode', choices=JOURNAL_MODES)
+    args = parser.parse_args()
+
+    if args.mode:
+        run(args)
+        return
+
+    # Each mode gets a fresh process, since the journal mode is fixed at import
+    for mode in JOURNAL_MODES:
+        subprocess.run(
+            [sys.executable, __file__, '--users', str(args.users), '--seconds', str(args.seconds), '--mode', mode],
+            env={**os.environ, 'TRACKMAN_JOURNAL_MODE': mode},
+            check=True
+        )
+
+if __name__ == '__main__':
+    main()
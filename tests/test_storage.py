@@ -0,0 +1,321 @@
+import asyncio
+import random
+from datetime import date, datetime, timedelta
+
+import pytest
+from sqlalchemy import Boolean, Column, DateTime, Integer, MetaData, String, Table, create_engine, select
+
+GUILD = '900000000000000001'
+USER = '100000000000000001'
+OTHER = '100000000000000002'
+
+def rollups(track, session, kind):
+    table = track.ActivityRollup.__table__
+    return {
+        (user_id, day, key): seconds
+        for user_id, day, key, seconds in session.execute(
+            select(table.c.user_id, table.c.day, table.c.key, table.c.seconds).where(table.c.guild_id == GUILD, table.c.kind == kind)
+        )
+    }
+
+def counters(track, session):
+    table = track.BadgeCounter.__table__
+    return {
+        (user_id, counter): value
+        for user_id, counter, value in session.execute(select(table.c.user_id, table.c.counter, table.c.value).where(table.c.guild_id == GUILD))
+    }
+
+def open_rows(track, session, kind):
+    model, _ = track.TRACKED_KINDS[kind]
+    return session.execute(track.select_intervals(kind, 'user_id', 'value').where(model.__table__.c.end_time == None)).all()
+
+def test_fresh_database_is_at_latest_version(track):
+    session = track.Session()
+    assert session.execute(select(track.SchemaVersion.version)).scalar() == len(track.MIGRATIONS)
+
+    # Migrating again is a no-op
+    track.migrate_schema()
+    assert session.execute(select(track.SchemaVersion.version)).scalar() == len(track.MIGRATIONS)
+    session.close()
+
+def test_legacy_database_is_migrated(database_url, load_track):
+    # The schema before intervals were guild scoped, with game names inline
+    start = datetime(2026, 1, 5, 20, 0)
+    engine = create_engine(database_url)
+    legacy = MetaData()
+    tables = {
+        name: Table(
+            name, legacy, Column('id', Integer, primary_key=True), Column('user_id', String), Column(column, String),
+            Column('start_time', DateTime), Column('end_time', DateTime)
+        )
+        for name, column in (('user_activity', 'status'), ('game_activity', 'game'), ('voice_activity', 'channel_id'))
+    }
+    settings = Table(
+        'server_settings', legacy, Column('id', Integer, primary_key=True), Column('server_id', String, unique=True),
+        Column('track_status', Boolean), Column('track_games', Boolean), Column('track_voice', Boolean),
+        Column('use_badges', Boolean), Column('notification_channel_id', String)
+    )
+    legacy.create_all(engine)
+    with engine.begin() as conn:
+        conn.execute(settings.insert().values(server_id=GUILD, track_status=True, track_games=True, track_voice=True, use_badges=True))
+        conn.execute(tables['user_activity'].insert().values(user_id=USER, status='online', start_time=start, end_time=start + timedelta(hours=2)))
+        conn.execute(tables['game_activity'].insert(), [
+            {'user_id': USER, 'game': 'Chess', 'start_time': start, 'end_time': start + timedelta(hours=1)},
+            {'user_id': USER, 'game': 'Go', 'start_time': start + timedelta(hours=1), 'end_time': None},
+        ])
+    engine.dispose()
+
+    track = load_track()
+    session = track.Session()
+    assert session.execute(select(track.SchemaVersion.version)).scalar() == len(track.MIGRATIONS)
+    assert track.settings_cache == {} and track.load_settings(session)[GUILD].announce_start
+    assert not track.load_settings(session)[GUILD].track_voice_states
+
+    track.backfill_guild_ids(session, {GUILD: [USER]})
+    assert rollups(track, session, 'status') == {(USER, date(2026, 1, 5), 'online'): 7200}
+    assert rollups(track, session, 'game') == {(USER, date(2026, 1, 5), 'Chess'): 3600}
+    assert open_rows(track, session, 'game') == [(USER, 'Go')]
+    assert track.load_open_intervals(session, [GUILD]) == {(GUILD, USER, 'game'): {'Go': start + timedelta(hours=1)}}
+    session.close()
+
+def test_closed_intervals_roll_up_per_day(track):
+    start = datetime(2026, 1, 1, 23, 0)
+    end = start + timedelta(hours=2)
+    session = track.Session()
+    track.write_interval_batch(session, [
+        track.IntervalChange('status', GUILD, USER, None, None, 'online', start),
+        track.IntervalChange('game', GUILD, USER, None, None, 'Chess', start),
+        track.IntervalChange('game', GUILD, USER, None, None, 'Go', start),
+    ])
+    assert sorted(open_rows(track, session, 'game')) == [(USER, 'Chess'), (USER, 'Go')]
+
+    track.write_interval_batch(session, [
+        track.IntervalChange('status', GUILD, USER, start, 'online', 'idle', end),
+        track.IntervalChange('game', GUILD, USER, start, 'Chess', None, end),
+    ])
+
+    assert rollups(track, session, 'status') == {
+        (USER, date(2026, 1, 1), 'online'): 3600,
+        (USER, date(2026, 1, 2), 'online'): 3600,
+    }
+    assert rollups(track, session, 'game') == {
+        (USER, date(2026, 1, 1), 'Chess'): 3600,
+        (USER, date(2026, 1, 2), 'Chess'): 3600,
+    }
+    assert counters(track, session)[(USER, 'game_hours')] == 2
+    assert open_rows(track, session, 'status') == [(USER, 'idle')]
+    assert open_rows(track, session, 'game') == [(USER, 'Go')]
+    session.close()
+
+def test_bulk_insert_and_record_closed(track):
+    # On PostgreSQL with psycopg2 this goes through COPY
+    start = datetime(2026, 3, 1, 12, 0)
+    intervals = [(GUILD, user_id, 'game', 'Chess', start + timedelta(hours=i), start + timedelta(hours=i, minutes=30)) for i in range(4) for user_id in (USER, OTHER)]
+    session = track.Session()
+    track.resolve_game_ids(session, ['Chess'])
+    track.bulk_insert(session, track.GameActivity.__table__, [
+        {'guild_id': guild_id, 'user_id': user_id, 'game_id': track.stored_value(kind, value), 'start_time': start_time, 'end_time': end_time}
+        for guild_id, user_id, kind, value, start_time, end_time in intervals
+    ])
+    track.record_closed(session, sorted(intervals, key=lambda interval: (interval[0], interval[1], interval[4])))
+    session.commit()
+
+    assert session.query(track.GameActivity).count() == 8
+    assert rollups(track, session, 'game') == {
+        (USER, date(2026, 3, 1), 'Chess'): 7200,
+        (OTHER, date(2026, 3, 1), 'Chess'): 7200,
+    }
+    assert counters(track, session)[(OTHER, 'game_hours')] == 2
+    session.close()
+
+def test_recovery_closes_open_intervals_at_the_heartbeat(track):
+    start = datetime(2026, 2, 1, 10, 0)
+    heartbeat = start + timedelta(hours=3)
+    session = track.Session()
+    track.write_interval_batch(session, [
+        track.IntervalChange('status', GUILD, USER, None, None, 'online', start),
+        track.IntervalChange('voice', GUILD, USER, None, None, '42', start),
+        # Opened after the last heartbeat, so it lasted no time at all
+        track.IntervalChange('game', GUILD, OTHER, None, None, 'Chess', heartbeat + timedelta(minutes=5)),
+    ])
+    track.write_heartbeat(session, heartbeat)
+    assert track.last_heartbeat(session) == heartbeat
+
+    assert track.recover_intervals(session, None, heartbeat) == 3
+    for kind in ('status', 'voice', 'game'):
+        assert open_rows(track, session, kind) == []
+    assert rollups(track, session, 'status') == {(USER, date(2026, 2, 1), 'online'): 3 * 3600}
+    assert rollups(track, session, 'voice') == {(USER, date(2026, 2, 1), '42'): 3 * 3600}
+    assert rollups(track, session, 'game') == {}
+    assert track.load_open_intervals(session, [GUILD]) == {}
+    session.close()
+
+def test_retention_compacts_old_rollups(track):
+    today = datetime.utcnow().date()
+    session = track.Session()
+    track.write_rollups(session, {
+        (GUILD, USER, 'status', today - timedelta(days=days), 'online'): 60.0
+        for days in range(track.DAILY_ROLLUP_DAYS + 20)
+    })
+    session.commit()
+    before = {days: track.rollup_totals(session, GUILD, 'status', track.window_start(days, datetime.utcnow()).date() if days else None) for days in (7, 30, None)}
+
+    cutoff_day = today - timedelta(days=track.DAILY_ROLLUP_DAYS)
+    while track.compact_rollups(session, cutoff_day) == track.RETENTION_CHUNK:
+        pass
+
+    days = {day for _, day, _ in rollups(track, session, 'status')}
+    assert min(days) == track.ALL_TIME_DAY
+    assert sorted(days)[1] >= cutoff_day
+    assert before == {days: track.rollup_totals(session, GUILD, 'status', track.window_start(days, datetime.utcnow()).date() if days else None) for days in (7, 30, None)}
+    session.close()
+
+def test_insights_are_built_from_rollups(track):
+    # Snowflake user ids, which overflow a 32 bit integer
+    now = datetime.utcnow()
+    midnight = datetime(now.year, now.month, now.day)
+    online = midnight - timedelta(days=2) + timedelta(hours=10)
+    playing = midnight - timedelta(days=1) + timedelta(hours=20)
+    session = track.Session()
+    track.write_interval_batch(session, [
+        track.IntervalChange('status', GUILD, USER, None, None, 'online', online),
+        track.IntervalChange('status', GUILD, USER, online, 'online', 'idle', online + timedelta(hours=1)),
+        track.IntervalChange('game', GUILD, USER, None, None, 'Stalking Simulator', online),
+        track.IntervalChange('game', GUILD, USER, online, 'Stalking Simulator', None, online + timedelta(hours=1)),
+        track.IntervalChange('game', GUILD, OTHER, None, None, 'Chess', playing),
+    ])
+
+    insights = track.build_insights(session, GUILD, now, [(OTHER, 'game', 'Chess', playing)])
+    hours, daily = insights.totals('online', *track.interval_arrays([]))
+    assert hours.sum() == 3600 and hours[25 * 24 + 10] == 3600
+    assert list(daily[-3:]) == [1, 0, 0]
+    hours, daily = insights.totals('games', *track.interval_arrays([(track.epoch_seconds(playing), track.epoch_seconds(now))]))
+    assert hours.sum() == pytest.approx((now - playing).total_seconds())
+    assert list(daily[-3:]) == [0, 1, 1]
+
+    # Closing the game is folded in without counting its player twice
+    closed = [track.IntervalChange('game', GUILD, OTHER, playing, 'Chess', None, now)]
+    sequence, marked = track.write_interval_batch(session, closed)
+    assert sequence > insights.built and marked == []
+    track.fold_batch(insights, closed, marked)
+    hours, daily = insights.totals('games', *track.interval_arrays([]))
+    assert hours.sum() == pytest.approx((now - playing).total_seconds())
+    assert list(daily[-3:]) == [0, 1, 1]
+    assert list(track.build_insights(session, GUILD, now, []).daily['games'][-3:]) == [0, 1, 1]
+    session.close()
+
+def random_game_batches(seed, start, batches=8, size=40):
+    # Players switching between games, sometimes several at once
+    rng = random.Random(seed)
+    users = [str(100000000000000000 + i) for i in range(2, 32)]
+    playing = {user_id: {} for user_id in users}
+    time, result = start, []
+    for _ in range(batches):
+        batch = []
+        for _ in range(size):
+            time += timedelta(seconds=rng.randint(1, 600))
+            user_id = rng.choice(users)
+            games = playing[user_id]
+            if games and rng.random() < 0.5:
+                game = rng.choice(sorted(games))
+                switched = rng.choice([None, 'Chess', 'Go', 'Stalking Simulator'])
+                switched = None if switched in games else switched
+                batch.append(('game', GUILD, user_id, games.pop(game), game, switched, time))
+            else:
+                switched = rng.choice([game for game in ('Chess', 'Go', 'Stalking Simulator') if game not in games] or [None])
+                if switched is None:
+                    continue
+                batch.append(('game', GUILD, user_id, None, None, switched, time))
+            if switched is not None:
+                games[switched] = time
+        result.append(batch)
+    return result, time
+
+def brute_force_ranking(track, batches, now):
+    scores, opened = {}, {}
+    for batch in batches:
+        for _, _, user_id, closed_start, closed_value, value, time in batch:
+            if closed_start and track.counts_towards('games', closed_value):
+                scores[user_id] = scores.get(user_id, 0) + (time - closed_start).total_seconds()
+                opened[user_id].remove(closed_start)
+            if value is not None and track.counts_towards('games', value):
+                opened.setdefault(user_id, []).append(time)
+    for user_id, starts in opened.items():
+        scores[user_id] = scores.get(user_id, 0) + sum((now - start).total_seconds() for start in starts)
+    ranked = [(user_id, score) for user_id, score in scores.items() if score or opened.get(user_id)]
+    return sorted(ranked, key=lambda row: (-row[1], row[0]))
+
+@pytest.mark.parametrize('seed', range(3))
+def test_ranked_index_matches_brute_force(track, seed):
+    batches, last = random_game_batches(seed, datetime(2026, 3, 1))
+    session = track.Session()
+    index = None
+    for i, batch in enumerate(batches):
+        changes = [track.IntervalChange(*change) for change in batch]
+        sequence, _ = track.write_interval_batch(session, changes)
+        if index is None and i == len(batches) // 2:
+            index = track.build_ranked_index(session, GUILD, 'games', None, changes[-1].time)
+        elif index is not None:
+            assert sequence > index.built
+            for change in changes:
+                track.apply_ranking(index, 'games', change)
+    session.close()
+
+    now = last + timedelta(hours=1)
+    expected = brute_force_ranking(track, batches, now)
+    assert len(index) == len(expected)
+    for offset in range(0, len(expected) + 5, 7):
+        assert index.page(offset, 10, now) == [(user_id, pytest.approx(score)) for user_id, score in expected[offset:offset + 10]]
+    for position, (user_id, _) in enumerate(expected, 1):
+        assert index.rank(user_id, now) == position
+    assert index.rank(USER, now) is None
+
+def test_ranked_index_keeps_batches_written_while_it_builds(track):
+    start = datetime.utcnow() - timedelta(hours=2)
+    session = track.Session()
+    track.write_interval_batch(session, [track.IntervalChange('game', GUILD, USER, None, None, 'Chess', start)])
+    session.close()
+
+    async def scenario():
+        # The build is queued on the writer ahead of the batch, but stored after it
+        loading = asyncio.ensure_future(track.ranked_index(GUILD, 'games', None))
+        while not track.ranked_pending:
+            await asyncio.sleep(0)
+        batch = [
+            track.IntervalChange('game', GUILD, USER, start, 'Chess', None, start + timedelta(hours=1)),
+            track.IntervalChange('game', GUILD, OTHER, None, None, 'Go', start),
+        ]
+        sequence, _ = await track.run_db(track.write_interval_batch, batch, write=True)
+        track.update_rankings(batch, sequence)
+        return await loading
+
+    index = asyncio.run(scenario())
+    assert index.built < track.batches_written
+    assert track.ranked_pending == {}
+    assert [user_id for user_id, _ in index.page(0, 10, datetime.utcnow())] == [OTHER, USER]
+    assert index.closed[USER] == 3600 and USER not in index.open_starts
+
+@pytest.mark.parametrize('fmt', ['csv', 'ndjson'])
+def test_export_format_is_read_from_the_file(track, tmp_path, fmt):
+    start = datetime(2026, 4, 1, 12, 0)
+    session = track.Session()
+    track.write_interval_batch(session, [
+        track.IntervalChange('game', GUILD, USER, None, None, 'Go, "the game"', start),
+        track.IntervalChange('game', GUILD, USER, start, 'Go, "the game"', None, start + timedelta(hours=1)),
+        track.IntervalChange('status', GUILD, OTHER, None, None, 'online', start),
+    ])
+    session.close()
+
+    # Neither format needs its usual suffix
+    path = str(tmp_path / 'history.gz')
+    assert track.export_intervals(path, fmt, GUILD) == 2
+    assert sorted((row['kind'], row['value'], row['end_time'] or None) for row in track.read_export(path)) == [
+        ('game', 'Go, "the game"', (start + timedelta(hours=1)).isoformat()),
+        ('status', 'online', None),
+    ]
+    assert track.import_intervals(path) == (1, 1)
+
+    # Running trackers are told the guild's rollups changed
+    session = track.Session()
+    assert track.load_rollup_versions(session) == {GUILD: 1}
+    session.close()
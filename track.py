@@ -1,45 +1,200 @@
 import discord
 from discord.ext import commands
+import argparse
 import asyncio
+import csv
+import gzip
+import io
+import json
+import logging
 import os
+import sys
+import threading
+from aiohttp import web
+import numpy as np
 from dotenv import load_dotenv
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, Float, func, Boolean
+from sqlalchemy import create_engine, event, Column, Integer, String, DateTime, Date, Float, func, Boolean, bindparam, case, ForeignKey, Index, MetaData, inspect, literal, literal_column, select, text
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.orm import declarative_base, sessionmaker
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
+from collections import OrderedDict, deque, namedtuple
+from itertools import chain, zip_longest
+from bisect import bisect_left, insort
+from typing import Optional
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
 
 # Load environment variables
 load_dotenv()
 TOKEN = os.getenv('DISCORD_TOKEN')
+# Any SQLAlchemy URL; SQLite and PostgreSQL are supported
+DATABASE_URL = os.getenv('DATABASE_URL', 'sqlite:///tracker.db')
+
+log = logging.getLogger('trackman')
+
+# Database setup. The pool keeps a connection per reader thread plus the writer.
+# On SQLite, WAL lets command reads run alongside the tracker's writes.
+DB_READ_WORKERS = 4
+SQLITE_JOURNAL_MODE = os.getenv('TRACKMAN_JOURNAL_MODE', 'WAL')
+SQLITE_PRAGMAS = [
+    f'journal_mode = {SQLITE_JOURNAL_MODE}',
+    'synchronous = NORMAL',
+    'cache_size = -65536',
+    'mmap_size = 268435456',
+    'temp_store = MEMORY',
+    'busy_timeout = 5000',
+]
+CHECKPOINT_INTERVAL = 5 * 60
 
-# Database setup
 Base = declarative_base()
-engine = create_engine('sqlite:///tracker.db')
-Session = sessionmaker(bind=engine)
+engine = create_engine(DATABASE_URL, pool_size=DB_READ_WORKERS + 1, max_overflow=2)
+Session = sessionmaker(bind=engine, expire_on_commit=False)
+SQLITE = engine.dialect.name == 'sqlite'
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for pragma in SQLITE_PRAGMAS:
+        cursor.execute(f'PRAGMA {pragma}')
+    cursor.close()
+
+if SQLITE:
+    event.listen(engine, 'connect', set_sqlite_pragmas)
+
+# In-process metrics: latency histograms and counters keyed by name and labels,
+# served as Prometheus text on TRACKMAN_METRICS_PORT and summarised by =perf.
+# Observations come from the event loop and the database threads alike.
+METRIC_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+METRIC_SAMPLES = 1000  # Recent observations kept per histogram for =perf percentiles
+metrics_lock = threading.Lock()
+histograms = {}
+metric_counts = {}
+
+class Histogram:
+    def __init__(self):
+        self.buckets = [0] * (len(METRIC_BUCKETS) + 1)
+        self.total = 0
+        self.count = 0
+        self.recent = deque(maxlen=METRIC_SAMPLES)
+
+    def observe(self, seconds):
+        self.buckets[bisect_left(METRIC_BUCKETS, seconds)] += 1
+        self.total += seconds
+        self.count += 1
+        self.recent.append(seconds)
+
+    def percentile(self, fraction):
+        recent = sorted(self.recent)
+        return recent[min(int(len(recent) * fraction), len(recent) - 1)] if recent else 0
+
+def metric_key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+def observe(name, seconds, **labels):
+    key = metric_key(name, labels)
+    with metrics_lock:
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = Histogram()
+        histogram.observe(seconds)
+
+def count(name, amount=1, **labels):
+    key = metric_key(name, labels)
+    with metrics_lock:
+        metric_counts[key] = metric_counts.get(key, 0) + amount
+
+def start_query(conn, cursor, statement, parameters, context, executemany):
+    conn.info['query_started'] = perf_counter()
+
+def finish_query(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.pop('query_started', None)
+    if started is not None:
+        observe('trackman_query_seconds', perf_counter() - started, statement=statement.split(None, 1)[0].upper())
+
+event.listen(engine, 'before_cursor_execute', start_query)
+event.listen(engine, 'after_cursor_execute', finish_query)
+
+# discord.py handles rate limits itself and only logs them
+class RateLimitCounter(logging.Handler):
+    def emit(self, record):
+        if 'rate limit' in record.getMessage():
+            count('trackman_rate_limits_total')
+
+logging.getLogger('discord.http').addHandler(RateLimitCounter(logging.WARNING))
+
+def upsert(table):
+    # Both dialects spell INSERT ... ON CONFLICT the same way
+    return (sqlite_insert if SQLITE else postgresql_insert)(table)
+
+def bulk_insert(session, table, rows):
+    # Postgres ingests through COPY, which is far cheaper than a multi-row INSERT
+    if engine.dialect.name != 'postgresql' or engine.dialect.driver != 'psycopg2':
+        session.execute(table.insert(), rows)
+        return
+
+    columns = list(rows[0])
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows([row[column] for column in columns] for row in rows)
+    buffer.seek(0)
+    cursor = session.connection().connection.cursor()
+    cursor.copy_expert(f'COPY {table.name} ({", ".join(columns)}) FROM STDIN WITH (FORMAT csv)', buffer)
+
+def activity_indexes(table):
+    return (
+        Index(f'ix_{table}_guild_user_start', 'guild_id', 'user_id', 'start_time'),
+        Index(f'ix_{table}_guild_start', 'guild_id', 'start_time'),
+        # Only open intervals, which is all the tracker ever looks up
+        Index(f'ix_{table}_open', 'guild_id', 'user_id', sqlite_where=text('end_time IS NULL'), postgresql_where=text('end_time IS NULL')),
+    )
 
 class UserActivity(Base):
     __tablename__ = 'user_activity'
+    __table_args__ = activity_indexes('user_activity')
     id = Column(Integer, primary_key=True)
+    guild_id = Column(String)
     user_id = Column(String)
     status = Column(String)
     start_time = Column(DateTime)
     end_time = Column(DateTime)
 
+# Game names are stored once and referenced by id from every interval
+class Game(Base):
+    __tablename__ = 'game'
+    id = Column(Integer, primary_key=True)
+    name = Column(String, unique=True, nullable=False)
+
 class GameActivity(Base):
     __tablename__ = 'game_activity'
+    __table_args__ = activity_indexes('game_activity')
     id = Column(Integer, primary_key=True)
+    guild_id = Column(String)
     user_id = Column(String)
-    game = Column(String)
+    game_id = Column(Integer, ForeignKey('game.id'))
     start_time = Column(DateTime)
     end_time = Column(DateTime)
 
 class VoiceActivity(Base):
     __tablename__ = 'voice_activity'
+    __table_args__ = activity_indexes('voice_activity')
     id = Column(Integer, primary_key=True)
+    guild_id = Column(String)
     user_id = Column(String)
     channel_id = Column(String)
     start_time = Column(DateTime)
     end_time = Column(DateTime)
 
+# Mute, deafen, stream and video states while in a voice channel
+class VoiceStateActivity(Base):
+    __tablename__ = 'voice_state_activity'
+    __table_args__ = activity_indexes('voice_state_activity')
+    id = Column(Integer, primary_key=True)
+    guild_id = Column(String)
+    user_id = Column(String)
+    state = Column(String)
+    start_time = Column(DateTime)
+    end_time = Column(DateTime)
+
 class ServerSettings(Base):
     __tablename__ = 'server_settings'
     id = Column(Integer, primary_key=True)
@@ -47,14 +202,486 @@ class ServerSettings(Base):
     track_status = Column(Boolean, default=True)
     track_games = Column(Boolean, default=True)
     track_voice = Column(Boolean, default=True)
+    track_voice_states = Column(Boolean, default=False)
     use_badges = Column(Boolean, default=True)
     notification_channel_id = Column(String, nullable=True)
+    announce_start = Column(Boolean, default=True)
+    announce_stop = Column(Boolean, default=True)
+    announce_errors = Column(Boolean, default=True)
+
+# Per day totals of closed intervals; key is the status, game or channel id
+class ActivityRollup(Base):
+    __tablename__ = 'activity_rollup'
+    __table_args__ = (
+        Index('ux_activity_rollup', 'guild_id', 'user_id', 'kind', 'day', 'key', unique=True),
+        # Covers leaderboard scans so they never touch the table itself
+        Index('ix_activity_rollup_guild_kind_day', 'guild_id', 'kind', 'day', 'user_id', 'key', 'seconds'),
+    )
+    id = Column(Integer, primary_key=True)
+    guild_id = Column(String)
+    user_id = Column(String)
+    kind = Column(String)
+    day = Column(Date)
+    key = Column(String)
+    seconds = Column(Float, default=0)
+
+# Behind =insights, for the last few weeks only: seconds per hour summed over a
+# guild's members, and each member active on a day, per leaderboard category
+class ActivityHourly(Base):
+    __tablename__ = 'activity_hourly'
+    __table_args__ = (Index('ux_activity_hourly', 'guild_id', 'category', 'hour', unique=True),)
+    id = Column(Integer, primary_key=True)
+    guild_id = Column(String)
+    category = Column(String)
+    hour = Column(DateTime)
+    seconds = Column(Float, default=0)
+
+class ActiveMember(Base):
+    __tablename__ = 'active_member'
+    __table_args__ = (Index('ux_active_member', 'guild_id', 'category', 'day', 'user_id', unique=True),)
+    id = Column(Integer, primary_key=True)
+    guild_id = Column(String)
+    category = Column(String)
+    day = Column(Date)
+    user_id = Column(String)
+
+# Running per-user badge counters, advanced as intervals close so badge checks
+# never rescan history. last_day is the last day counted towards a streak.
+class BadgeCounter(Base):
+    __tablename__ = 'badge_counter'
+    __table_args__ = (Index('ux_badge_counter', 'guild_id', 'user_id', 'counter', unique=True),)
+    id = Column(Integer, primary_key=True)
+    guild_id = Column(String)
+    user_id = Column(String)
+    counter = Column(String)
+    value = Column(Float, default=0)
+    last_day = Column(Date, nullable=True)
+
+# When each tracker process last knew its members' state; open intervals are
+# closed here after a crash. process is 'all' or the process's shard ids.
+class Heartbeat(Base):
+    __tablename__ = 'heartbeat'
+    id = Column(Integer, primary_key=True)
+    process = Column(String, unique=True)
+    last_seen = Column(DateTime)
+
+# Bumped for each guild an import adds history to, so running trackers know to
+# drop whatever they built from its rollups before
+class RollupVersion(Base):
+    __tablename__ = 'rollup_version'
+    id = Column(Integer, primary_key=True)
+    guild_id = Column(String, unique=True)
+    version = Column(Integer, default=0)
+
+class SchemaVersion(Base):
+    __tablename__ = 'schema_version'
+    id = Column(Integer, primary_key=True)
+    version = Column(Integer)
+
+ACTIVITY_MODELS = (UserActivity, GameActivity, VoiceActivity, VoiceStateActivity)
+
+# Schema migrations, applied in order to databases created by older versions.
+# Each takes a connection inside the migration transaction. Migrations that run
+# before migrate_game_ids() read game names from the old game column.
+def legacy_value(table, column):
+    return literal_column('game') if column == 'game_id' else table.c[column]
+
+def migrate_guild_scope(conn):
+    # Existing rows keep a NULL guild_id until backfill_guild_ids() assigns them.
+    # Later interval tables are created by create_all with the column already.
+    for model in (UserActivity, GameActivity, VoiceActivity):
+        conn.execute(text(f'ALTER TABLE {model.__tablename__} ADD COLUMN guild_id VARCHAR'))
+        for index in model.__table__.indexes:
+            index.create(conn, checkfirst=True)
+
+def migrate_rollups(conn):
+    # The rollup table itself is created by create_all; fold in the history
+    totals = {}
+    for kind, (model, column) in TRACKED_KINDS.items():
+        table = model.__table__
+        rows = conn.execute(
+            select(table.c.guild_id, table.c.user_id, legacy_value(table, column), table.c.start_time, table.c.end_time).where(
+                table.c.guild_id != None,
+                table.c.end_time != None
+            ).execution_options(stream_results=True)
+        )
+        for guild_id, user_id, key, start_time, end_time in rows:
+            add_rollup(totals, guild_id, user_id, kind, key, start_time, end_time)
+            if len(totals) >= ROLLUP_FLUSH_SIZE:
+                write_rollups(conn, totals)
+                totals = {}
+    write_rollups(conn, totals)
+
+def migrate_badge_counters(conn):
+    # Streaks need each user's intervals in order
+    counters = {}
+    for kind in COUNTED_KINDS:
+        model, column = TRACKED_KINDS[kind]
+        table = model.__table__
+        rows = conn.execute(
+            select(table.c.guild_id, table.c.user_id, legacy_value(table, column), table.c.start_time, table.c.end_time).where(
+                table.c.guild_id != None,
+                table.c.end_time != None
+            ).order_by(table.c.guild_id, table.c.user_id, table.c.start_time).execution_options(stream_results=True)
+        )
+        for guild_id, user_id, key, start_time, end_time in rows:
+            add_counters(counters, guild_id, user_id, kind, key, start_time, end_time)
+    write_counters(conn, counters)
+
+def migrate_announcement_settings(conn):
+    for column in ('announce_start', 'announce_stop', 'announce_errors'):
+        conn.execute(text(f'ALTER TABLE server_settings ADD COLUMN {column} BOOLEAN DEFAULT TRUE'))
+
+def migrate_game_ids(conn):
+    # The game table itself is created by create_all. Intervals are copied into a
+    # rebuilt table, which comes out compact where updating rows in place would
+    # leave them spread over half-empty pages.
+    conn.execute(text('INSERT INTO game (name) SELECT DISTINCT game FROM game_activity WHERE game IS NOT NULL'))
+    for index in GameActivity.__table__.indexes:
+        conn.execute(text(f'DROP INDEX IF EXISTS {index.name}'))
+    metadata = MetaData()
+    Game.__table__.to_metadata(metadata)
+    GameActivity.__table__.to_metadata(metadata, name='game_activity_new').create(conn)
+    conn.execute(text(
+        'INSERT INTO game_activity_new (guild_id, user_id, game_id, start_time, end_time) '
+        'SELECT a.guild_id, a.user_id, game.id, a.start_time, a.end_time '
+        'FROM game_activity a LEFT JOIN game ON game.name = a.game ORDER BY a.id'
+    ))
+    conn.execute(text('DROP TABLE game_activity'))
+    conn.execute(text('ALTER TABLE game_activity_new RENAME TO game_activity'))
+
+def migrate_voice_state_settings(conn):
+    conn.execute(text('ALTER TABLE server_settings ADD COLUMN track_voice_states BOOLEAN DEFAULT FALSE'))
+
+def migrate_insights_rollups(conn):
+    # Both tables are created by create_all; only recent history is kept
+    horizon = insights_horizon()
+    hourly, members = {}, set()
+    for category, (kind, _) in LEADERBOARD_CATEGORIES.items():
+        table = TRACKED_KINDS[kind][0].__table__
+        rows = conn.execute(
+            select_intervals(kind, 'guild_id', 'user_id', 'value', 'start_time', 'end_time').where(
+                table.c.guild_id != None,
+                table.c.end_time > horizon
+            ).execution_options(stream_results=True)
+        )
+        for guild_id, user_id, key, start_time, end_time in rows:
+            add_insights(hourly, members, guild_id, user_id, kind, key, start_time, end_time, horizon)
+            if len(hourly) + len(members) >= ROLLUP_FLUSH_SIZE:
+                write_insights(conn, hourly, members)
+                hourly, members = {}, set()
+    write_insights(conn, hourly, members)
 
-Base.metadata.create_all(engine)
+MIGRATIONS = [
+    migrate_guild_scope,
+    migrate_rollups,
+    migrate_badge_counters,
+    migrate_announcement_settings,
+    migrate_game_ids,
+    migrate_voice_state_settings,
+    migrate_insights_rollups,
+]
+
+def migrate_schema():
+    with engine.begin() as conn:
+        fresh = not inspect(conn).has_table(UserActivity.__tablename__)
+        Base.metadata.create_all(conn)
+
+        version = conn.execute(select(SchemaVersion.version)).scalar()
+        if version is None:
+            # New databases are created at the latest schema and skip every migration
+            version = len(MIGRATIONS) if fresh else 0
+            conn.execute(SchemaVersion.__table__.insert().values(id=1, version=version))
+
+        for number in range(version, len(MIGRATIONS)):
+            log.info("Applying schema migration %d (%s)", number + 1, MIGRATIONS[number].__name__)
+            MIGRATIONS[number](conn)
+            conn.execute(SchemaVersion.__table__.update().values(version=number + 1))
+
+# Maps each tracked kind to its interval table and the column holding its value.
+# Games and voice states are the kinds a member can have several of open at once.
+TRACKED_KINDS = {
+    'status': (UserActivity, 'status'),
+    'game': (GameActivity, 'game_id'),
+    'voice': (VoiceActivity, 'channel_id'),
+    'voice_state': (VoiceStateActivity, 'state'),
+}
+CONCURRENT_KINDS = ('game', 'voice_state')
+
+def select_intervals(kind, *names):
+    # Selects the named columns of a kind's intervals; 'value' is the tracked
+    # value, with game ids resolved back to their names
+    model, column = TRACKED_KINDS[kind]
+    table = model.__table__
+    value, source = table.c[column], table
+    if column == 'game_id':
+        games = Game.__table__
+        value, source = games.c.name, table.join(games, table.c.game_id == games.c.id)
+    return select(*(value if name == 'value' else table.c[name] for name in names)).select_from(source)
+
+# Game name to id, only used on the writer thread. Names are committed before
+# any interval refers to them, so a failed batch never leaves a stale id here.
+game_ids = {}
+
+def resolve_game_ids(session, names):
+    missing = list({name for name in names if name not in game_ids})
+    if not missing:
+        return
+    table = Game.__table__
+    for i in range(0, len(missing), QUERY_CHUNK):
+        chunk = missing[i:i + QUERY_CHUNK]
+        session.execute(upsert(table).on_conflict_do_nothing(index_elements=['name']), [{'name': name} for name in chunk])
+        game_ids.update((name, game_id) for game_id, name in session.execute(select(table.c.id, table.c.name).where(table.c.name.in_(chunk))))
+    session.commit()
+
+def stored_value(kind, value):
+    return game_ids[value] if kind == 'game' else value
+
+ROLLUP_FLUSH_SIZE = 50000
+QUERY_CHUNK = 500
+
+def split_by_day(start_time, end_time):
+    while start_time < end_time:
+        midnight = datetime(start_time.year, start_time.month, start_time.day) + timedelta(days=1)
+        chunk_end = min(end_time, midnight)
+        yield start_time.date(), (chunk_end - start_time).total_seconds()
+        start_time = chunk_end
+
+def add_rollup(totals, guild_id, user_id, kind, key, start_time, end_time):
+    for day, seconds in split_by_day(start_time, end_time):
+        rollup_key = (guild_id, user_id, kind, day, key)
+        totals[rollup_key] = totals.get(rollup_key, 0) + seconds
+
+def write_rollups(conn, totals):
+    if not totals:
+        return
+    table = ActivityRollup.__table__
+    stmt = upsert(table)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['guild_id', 'user_id', 'kind', 'day', 'key'],
+        set_={'seconds': table.c.seconds + stmt.excluded.seconds}
+    )
+    conn.execute(stmt, [
+        {'guild_id': guild_id, 'user_id': user_id, 'kind': kind, 'day': day, 'key': key, 'seconds': seconds}
+        for (guild_id, user_id, kind, day, key), seconds in totals.items()
+    ])
+
+# Leaderboard and insights categories, and the keys counted towards each
+LEADERBOARD_CATEGORIES = {
+    'online': ('status', "Online Time Leaderboard"),
+    'games': ('game', "Gaming Time Leaderboard"),
+    'voice': ('voice', "Voice Channel Time Leaderboard"),
+}
+
+def counts_towards(category, key):
+    if category == 'online':
+        return key == 'online'
+    if category == 'games':
+        return key != "Stalking Simulator"
+    return True
+
+def insights_category(kind, key):
+    for category, (category_kind, _) in LEADERBOARD_CATEGORIES.items():
+        if category_kind == kind and counts_towards(category, key):
+            return category
+    return None
+
+# Insights rollups reach back a day before the four week window
+INSIGHTS_ROLLUP_DAYS = 29
+
+def insights_horizon():
+    now = datetime.utcnow()
+    return datetime(now.year, now.month, now.day) - timedelta(days=INSIGHTS_ROLLUP_DAYS)
+
+def split_by_hour(start_time, end_time):
+    while start_time < end_time:
+        hour = start_time.replace(minute=0, second=0, microsecond=0)
+        chunk_end = min(end_time, hour + timedelta(hours=1))
+        yield hour, (chunk_end - start_time).total_seconds()
+        start_time = chunk_end
+
+def add_insights(hourly, members, guild_id, user_id, kind, key, start_time, end_time, horizon):
+    category = insights_category(kind, key)
+    if category is None:
+        return
+    start_time = max(start_time, horizon)
+    for hour, seconds in split_by_hour(start_time, end_time):
+        hourly_key = (guild_id, category, hour)
+        hourly[hourly_key] = hourly.get(hourly_key, 0) + seconds
+    for day, _ in split_by_day(start_time, end_time):
+        members.add((guild_id, category, day, user_id))
+
+def write_insights(conn, hourly, members):
+    # Returns the (guild_id, category, day, user_id) members that weren't
+    # marked active on that day yet
+    if hourly:
+        table = ActivityHourly.__table__
+        stmt = upsert(table)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=['guild_id', 'category', 'hour'],
+            set_={'seconds': table.c.seconds + stmt.excluded.seconds}
+        )
+        conn.execute(stmt, [
+            {'guild_id': guild_id, 'category': category, 'hour': hour, 'seconds': seconds}
+            for (guild_id, category, hour), seconds in hourly.items()
+        ])
+    if not members:
+        return []
+    table = ActiveMember.__table__
+    stmt = upsert(table).on_conflict_do_nothing(index_elements=['guild_id', 'category', 'day', 'user_id'])
+    return conn.execute(stmt.returning(table.c.guild_id, table.c.category, table.c.day, table.c.user_id), [
+        {'guild_id': guild_id, 'category': category, 'day': day, 'user_id': user_id}
+        for guild_id, category, day, user_id in members
+    ]).all()
+
+# Badge counters. Each closed interval advances them; counters maps
+# (guild_id, user_id, counter) to (value, last_day).
+COUNTED_KINDS = ('status', 'game')
+ACTIVE_STATUSES = ('online', 'idle', 'dnd')
+NIGHT_START, NIGHT_END = 0, 6  # UTC hours counted towards Night Owl
+
+def night_seconds(start_time, end_time):
+    seconds = 0
+    for day, _ in split_by_day(start_time, end_time):
+        night_start = datetime(day.year, day.month, day.day, NIGHT_START)
+        night_end = datetime(day.year, day.month, day.day, NIGHT_END)
+        seconds += max((min(end_time, night_end) - max(start_time, night_start)).total_seconds(), 0)
+    return seconds
+
+def extend_streak(counter, day):
+    value, last_day = counter
+    if last_day is not None and day <= last_day:
+        return counter
+    if last_day is not None and day == last_day + timedelta(days=1):
+        return value + 1, day
+    return 1, day
+
+def add_counter_value(counters, counter_key, amount):
+    if amount:
+        value, last_day = counters.get(counter_key, (0, None))
+        counters[counter_key] = (value + amount, last_day)
+
+def add_counters(counters, guild_id, user_id, kind, key, start_time, end_time):
+    if kind == 'status' and key == 'online':
+        streak_key = (guild_id, user_id, 'online_streak')
+        for day, _ in split_by_day(start_time, end_time):
+            counters[streak_key] = extend_streak(counters.get(streak_key, (0, None)), day)
+    if kind == 'status' and key in ACTIVE_STATUSES:
+        add_counter_value(counters, (guild_id, user_id, 'night_hours'), night_seconds(start_time, end_time) / 3600)
+    if kind == 'game':
+        add_counter_value(counters, (guild_id, user_id, 'game_hours'), (end_time - start_time).total_seconds() / 3600)
+
+def load_counters(session, pairs):
+    users = {}
+    for guild_id, user_id in pairs:
+        users.setdefault(guild_id, []).append(user_id)
+
+    counters = {}
+    for guild_id, user_ids in users.items():
+        for i in range(0, len(user_ids), QUERY_CHUNK):
+            rows = session.query(BadgeCounter.user_id, BadgeCounter.counter, BadgeCounter.value, BadgeCounter.last_day).filter(
+                BadgeCounter.guild_id == guild_id,
+                BadgeCounter.user_id.in_(user_ids[i:i + QUERY_CHUNK])
+            )
+            for user_id, counter, value, last_day in rows:
+                counters[(guild_id, user_id, counter)] = (value, last_day)
+    return counters
+
+def write_counters(conn, counters):
+    # Counters hold absolute values, loaded first by load_counters()
+    if not counters:
+        return
+    table = BadgeCounter.__table__
+    stmt = upsert(table)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['guild_id', 'user_id', 'counter'],
+        set_={'value': stmt.excluded.value, 'last_day': stmt.excluded.last_day}
+    )
+    conn.execute(stmt, [
+        {'guild_id': guild_id, 'user_id': user_id, 'counter': counter, 'value': value, 'last_day': last_day}
+        for (guild_id, user_id, counter), (value, last_day) in counters.items()
+    ])
+
+def record_closed(session, closed, opened=()):
+    # closed holds (guild_id, user_id, kind, key, start_time, end_time) in close
+    # order, opened (guild_id, user_id, kind, key, start_time). Returns the
+    # members newly marked active for insights.
+    totals, hourly, members = {}, {}, set()
+    horizon = insights_horizon()
+    for interval in closed:
+        add_rollup(totals, *interval)
+        add_insights(hourly, members, *interval, horizon)
+    for guild_id, user_id, kind, key, start_time in opened:
+        category = insights_category(kind, key)
+        if category and start_time >= horizon:
+            members.add((guild_id, category, start_time.date(), user_id))
+    write_rollups(session, totals)
+    marked = write_insights(session, hourly, members)
+
+    counters = load_counters(session, {(guild_id, user_id) for guild_id, user_id, kind, *_ in closed if kind in COUNTED_KINDS})
+    for interval in closed:
+        add_counters(counters, *interval)
+    write_counters(session, counters)
+    return marked
+
+def enable_incremental_vacuum():
+    # auto_vacuum only changes on an empty database or through a full VACUUM, so
+    # older databases pay for one VACUUM the first time they're opened
+    with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+        if conn.exec_driver_sql('PRAGMA auto_vacuum').scalar() != 2:
+            log.info("Enabling incremental vacuum")
+            conn.exec_driver_sql('PRAGMA auto_vacuum = INCREMENTAL')
+            conn.exec_driver_sql('VACUUM')
+
+if SQLITE:
+    enable_incremental_vacuum()
+migrate_schema()
 
 # Bot setup
-intents = discord.Intents.all()
-bot = commands.Bot(command_prefix='=', intents=intents)
+intents = discord.Intents.default()
+intents.members = True
+intents.presences = True
+intents.message_content = True
+
+class TrackMan(commands.AutoShardedBot):
+    async def setup_hook(self):
+        # Loaded before connecting so no event or command sees an empty cache
+        settings_cache.update(await run_db(load_settings))
+
+        # discord.py drops GUILD_CREATE presences of members it doesn't cache, so
+        # the member state store reads them first
+        parsers = self._connection.parsers
+        parse_guild_create = parsers['GUILD_CREATE']
+
+        def parse_and_seed(data):
+            seed_member_states(data)
+            parse_guild_create(data)
+
+        parsers['GUILD_CREATE'] = parse_and_seed
+
+    async def close(self):
+        # Pending interval changes must reach the database before we go, and the
+        # next start closes what's still open at this moment
+        await flush_writes()
+        if index_loaded.is_set():
+            await run_db(write_heartbeat, last_seen(), write=True)
+        await super().close()
+
+# Each process can run a subset of the shards, e.g. TRACKMAN_SHARD_COUNT=8 with
+# TRACKMAN_SHARD_IDS=0,1,2,3 here and 4,5,6,7 in a second process against the
+# same database. Guilds belong to exactly one shard, so processes never write the
+# same intervals, rollups or counters. Unset, one process runs every shard.
+SHARD_COUNT = int(os.getenv('TRACKMAN_SHARD_COUNT', 0)) or None
+SHARD_IDS = [int(shard_id) for shard_id in os.getenv('TRACKMAN_SHARD_IDS', '').split(',') if shard_id] or None
+# Database-wide maintenance only runs in the process holding shard 0
+PRIMARY_PROCESS = SHARD_IDS is None or 0 in SHARD_IDS
+
+# Members aren't cached: tracking reads the compact member_states store instead,
+# and the few places that need a full member fetch it
+bot = TrackMan(
+    command_prefix='=', intents=intents, shard_count=SHARD_COUNT, shard_ids=SHARD_IDS,
+    member_cache_flags=discord.MemberCacheFlags.none(), chunk_guilds_at_startup=False, enable_raw_presences=True
+)
 
 # TrackMan's user ID
 TRACKMAN_ID = None
@@ -88,172 +715,1214 @@ BADGES = {
 
 @bot.event
 async def on_ready():
-    global TRACKMAN_ID
+    global TRACKMAN_ID, tracking_started, writer_task
     TRACKMAN_ID = bot.user.id
     await bot.change_presence(activity=discord.Game(name="Stalking Simulator"))
-    bot.loop.create_task(track_activities())
-    
-    for guild in bot.guilds:
-        channel = guild.system_channel or next((ch for ch in guild.text_channels if ch.permissions_for(guild.me).send_messages), None)
-        if channel:
-            await channel.send("TrackMan has started its tracking shenanigans again!")
 
+    # on_ready fires again after a reconnect; only start the tracker once
+    if tracking_started:
+        bot.loop.create_task(reconcile_activities())
+    else:
+        tracking_started = True
+        if SHARD_IDS is None:
+            memberships = {str(guild.id): [str(user_id) for user_id in member_states.get(guild.id, {})] for guild in bot.guilds}
+            await run_db(backfill_guild_ids, memberships, write=True)
+        else:
+            # Placing legacy rows needs every guild a user is in
+            log.info("Skipping legacy interval backfill; run once without TRACKMAN_SHARD_IDS to place them")
+        seen = await run_db(last_heartbeat)
+        if seen:
+            recovered = await run_db(recover_intervals, None if SHARD_IDS is None else owned_guild_ids(), seen, write=True)
+            log.info("Closed %d intervals left open when tracking stopped at %s", recovered, seen)
+        reset_open_intervals(await run_db(load_open_intervals, owned_guild_ids(), write=True))
+        rollup_versions.update(await run_db(load_rollup_versions))
+        # GUILD_CREATE only lists members who are online, so anyone else with an
+        # open interval is known to be offline
+        for guild_id, user_id, _ in open_intervals:
+            if int(guild_id) in member_states:
+                member_state(int(guild_id), int(user_id))
+        index_loaded.set()
+        writer_task = bot.loop.create_task(interval_writer())
+        bot.loop.create_task(heartbeat_loop())
+        bot.loop.create_task(import_poll_loop())
+        for shard_id in bot.shards:
+            bot.loop.create_task(track_activities(shard_id))
+        bot.loop.create_task(badge_loop())
+        bot.loop.create_task(notification_sender())
+        bot.loop.create_task(monitor_loop_lag())
+        if METRICS_PORT:
+            bot.loop.create_task(serve_metrics())
+        if PRIMARY_PROCESS:
+            bot.loop.create_task(retention_loop())
+            if SQLITE and SQLITE_JOURNAL_MODE.upper() == 'WAL':
+                bot.loop.create_task(checkpoint_loop())
+
+    bot.loop.create_task(announce('start', bot.guilds))
 
 @bot.event
-async def on_disconnect():
-    for guild in bot.guilds:
-        channel = guild.system_channel or next((ch for ch in guild.text_channels if ch.permissions_for(guild.me).send_messages), None)
-        if channel:
-            await channel.send("TrackerMan dozes off, no more shenanigans :(")
+async def on_shard_disconnect(shard_id):
+    disconnected_at.setdefault(shard_id, datetime.utcnow())
+    await flush_writes()
+    bot.loop.create_task(announce('stop', shard_guilds(shard_id)))
 
 @bot.event
 async def on_error(event, *args, **kwargs):
-    for guild in bot.guilds:
-        channel = guild.system_channel or next((ch for ch in guild.text_channels if ch.permissions_for(guild.me).send_messages), None)
-        if channel:
-            await channel.send("That didn't work, messaging the dev real quick")
+    log.exception("Unhandled error in %s", event)
+    bot.loop.create_task(announce('error', bot.guilds))
     # Here you could add code to actually message the developer
 
+# Announcements run in the background and never hold up tracking. Each event
+# can be switched off per server and reaches a guild at most once per cooldown;
+# start only once per process, so reconnects don't repeat it. A few sends run at
+# a time and discord.py waits out each channel's rate limit bucket.
+ANNOUNCEMENTS = {
+    'start': ("TrackMan has started its tracking shenanigans again!", 'announce_start', None),
+    'stop': ("TrackerMan dozes off, no more shenanigans :(", 'announce_stop', 60 * 60),
+    'error': ("That didn't work, messaging the dev real quick", 'announce_errors', 60 * 60),
+}
+ANNOUNCE_CONCURRENCY = 5
+announce_slots = asyncio.Semaphore(ANNOUNCE_CONCURRENCY)
+announcement_channels = {}
+last_announced = {}
+
+def announcement_channel(guild):
+    if guild.id not in announcement_channels:
+        announcement_channels[guild.id] = guild.system_channel or next((ch for ch in guild.text_channels if ch.permissions_for(guild.me).send_messages), None)
+    return announcement_channels[guild.id]
+
+def invalidate_announcement_channel(guild):
+    announcement_channels.pop(guild.id, None)
+
+def wants_announcement(guild, event, now):
+    _, column, cooldown = ANNOUNCEMENTS[event]
+    settings = get_settings(str(guild.id))
+    if settings and not getattr(settings, column):
+        return False
+    last = last_announced.get((event, guild.id))
+    return last is None or (cooldown is not None and now - last >= cooldown)
+
+async def send_announcement(guild, message):
+    channel = announcement_channel(guild)
+    if not channel:
+        return
+    async with announce_slots:
+        try:
+            await channel.send(message)
+        except discord.Forbidden:
+            invalidate_announcement_channel(guild)
+        except discord.HTTPException:
+            log.warning("Announcing to %s failed", guild.id)
+
+async def announce(event, guilds):
+    now = asyncio.get_running_loop().time()
+    targets = [guild for guild in guilds if wants_announcement(guild, event, now)]
+    for guild in targets:
+        last_announced[(event, guild.id)] = now
+    message = ANNOUNCEMENTS[event][0]
+    await asyncio.gather(*(send_announcement(guild, message) for guild in targets))
+
+@bot.event
+async def on_guild_channel_create(channel):
+    invalidate_announcement_channel(channel.guild)
+
+@bot.event
+async def on_guild_channel_delete(channel):
+    invalidate_announcement_channel(channel.guild)
+
+@bot.event
+async def on_guild_channel_update(before, after):
+    invalidate_announcement_channel(after.guild)
+
+@bot.event
+async def on_guild_update(before, after):
+    invalidate_announcement_channel(after)
+
+@bot.event
+async def on_guild_remove(guild):
+    invalidate_announcement_channel(guild)
+    member_states.pop(guild.id, None)
+
+@bot.event
+async def on_member_update(before, after):
+    # Our own roles decide which channels we can post in
+    if after.id == TRACKMAN_ID and before.roles != after.roles:
+        invalidate_announcement_channel(after.guild)
+
 @bot.event
 async def on_guild_join(guild):
-    channel = guild.system_channel or next((ch for ch in guild.text_channels if ch.permissions_for(guild.me).send_messages), None)
+    channel = announcement_channel(guild)
     if channel:
         await channel.send(f"Thanks for adding TrackMan to {guild.name}! Please use the `=setup` command to configure the bot.")
-async def track_activities():
-    while True:
+
+# Database access runs off the event loop. Tracking writes go through a single
+# writer thread so interval opens and closes reach the database in order.
+db_readers = ThreadPoolExecutor(max_workers=DB_READ_WORKERS, thread_name_prefix='trackman-db')
+db_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='trackman-writer')
+
+async def run_db(fn, *args, write=False):
+    def call():
         session = Session()
-        for guild in bot.guilds:
-            settings = session.query(ServerSettings).filter_by(server_id=str(guild.id)).first()
+        try:
+            return fn(session, *args)
+        finally:
+            session.close()
+
+    return await asyncio.get_running_loop().run_in_executor(db_writer if write else db_readers, call)
+
+def checkpoint_wal(session):
+    # Readers hold the WAL open, so it only shrinks when truncated at a quiet moment
+    return session.execute(text('PRAGMA wal_checkpoint(TRUNCATE)')).first()
+
+async def checkpoint_loop():
+    while True:
+        await asyncio.sleep(CHECKPOINT_INTERVAL)
+        try:
+            busy, frames, checkpointed = await run_db(checkpoint_wal, write=True)
+        except Exception:
+            log.exception("WAL checkpoint failed")
+            continue
+        if busy:
+            log.info("WAL checkpoint incomplete: %d of %d frames checkpointed", checkpointed, frames)
+
+def fetch_settings(session, server_id):
+    return session.query(ServerSettings).filter_by(server_id=server_id).first()
+
+# Every guild's settings stay resident and admin commands write through, so
+# tracking, badges and commands never query them
+settings_cache = {}
+
+def load_settings(session):
+    return {settings.server_id: settings for settings in session.query(ServerSettings)}
+
+def get_settings(server_id):
+    settings = settings_cache.get(server_id)
+    count('trackman_settings_cache_total', result='hit' if settings else 'miss')
+    return settings
+
+def cache_settings(settings):
+    if settings:
+        settings_cache[settings.server_id] = settings
+    return settings
+
+# Tracking is event driven; this sweep only repairs state missed while disconnected
+RECONCILE_INTERVAL = 15 * 60
+reconcile_locks = {}
+tracking_started = False
+
+# Resident copy of every open interval, mapping (guild_id, user_id, kind) to
+# {value: start_time}, so deciding whether anything changed never needs a query.
+# Only concurrent kinds ever hold more than one value.
+IntervalChange = namedtuple('IntervalChange', 'kind guild_id user_id closed_start closed_value value time')
+open_intervals = {}
+index_loaded = asyncio.Event()
+# The keys of open_intervals per guild, so guild-wide lookups skip other guilds
+guild_interval_keys = {}
+
+def set_open_intervals(key, intervals):
+    if intervals:
+        open_intervals[key] = intervals
+        guild_interval_keys.setdefault(key[0], set()).add(key)
+    else:
+        pop_open_intervals(key)
+
+def pop_open_intervals(key):
+    keys = guild_interval_keys.get(key[0])
+    if keys:
+        keys.discard(key)
+        if not keys:
+            del guild_interval_keys[key[0]]
+    return open_intervals.pop(key, {})
+
+def reset_open_intervals(index):
+    open_intervals.clear()
+    guild_interval_keys.clear()
+    for key, intervals in index.items():
+        set_open_intervals(key, intervals)
+
+def owned_guild_ids():
+    return [str(guild.id) for guild in bot.guilds]
+
+def shard_guilds(shard_id):
+    return [guild for guild in bot.guilds if shard_id is None or guild.shard_id == shard_id]
+
+def load_open_intervals(session, guild_ids):
+    # Only this process's guilds; other shards' processes own the rest
+    index = {}
+    closed = []
+    for kind, (model, column) in TRACKED_KINDS.items():
+        table = model.__table__
+        rows = []
+        for i in range(0, len(guild_ids), QUERY_CHUNK):
+            rows.extend(session.execute(select_intervals(kind, 'id', 'guild_id', 'user_id', 'value', 'start_time').where(
+                table.c.end_time == None,
+                table.c.guild_id.in_(guild_ids[i:i + QUERY_CHUNK])
+            ).order_by(table.c.start_time)))
+
+        row_ids = {}
+        for row_id, guild_id, user_id, value, start_time in rows:
+            intervals = index.setdefault((guild_id, user_id, kind), {})
+            previous = value if kind in CONCURRENT_KINDS else next(iter(intervals), None)
+            if previous in intervals:
+                # A crash left the older interval dangling; it ended when this one started
+                closed.append((guild_id, user_id, kind, previous, intervals.pop(previous), start_time))
+                session.execute(table.update().where(table.c.id == row_ids[(guild_id, user_id, kind, previous)]).values(end_time=start_time))
+            intervals[value] = start_time
+            row_ids[(guild_id, user_id, kind, value)] = row_id
+    record_closed(session, closed)
+    session.commit()
+    return index
+
+def backfill_guild_ids(session, memberships):
+    # Rows written before intervals were guild scoped belong to every set-up guild
+    # the user is in. They are moved in place for the last of those guilds and
+    # copied for the others; users we can't place keep their legacy rows.
+    server_ids = {server_id for server_id, in session.query(ServerSettings.server_id)}
+    user_guilds = {}
+    for guild_id, user_ids in memberships.items():
+        if guild_id in server_ids:
+            for user_id in user_ids:
+                user_guilds.setdefault(user_id, []).append(guild_id)
+
+    copies, moves = {}, {}
+    for user_id, guild_ids in user_guilds.items():
+        for guild_id in guild_ids[:-1]:
+            copies.setdefault(guild_id, []).append(user_id)
+        moves.setdefault(guild_ids[-1], []).append(user_id)
+
+    for kind, (model, column) in TRACKED_KINDS.items():
+        table = model.__table__
+        if session.execute(select(table.c.id).where(table.c.guild_id == None).limit(1)).first() is None:
+            continue
+
+        # Placed rows count towards each of their guilds' rollups and badge counters
+        totals, hourly, members = {}, {}, set()
+        counters = {}
+        horizon = insights_horizon()
+        if kind in COUNTED_KINDS:
+            counters = load_counters(session, {(guild_id, user_id) for user_id, guild_ids in user_guilds.items() for guild_id in guild_ids})
+        rows = session.execute(
+            select_intervals(kind, 'user_id', 'value', 'start_time', 'end_time').where(
+                table.c.guild_id == None,
+                table.c.end_time != None
+            ).order_by(table.c.user_id, table.c.start_time).execution_options(yield_per=ROLLUP_FLUSH_SIZE)
+        )
+        for user_id, key, start_time, end_time in rows:
+            for guild_id in user_guilds.get(user_id, ()):
+                add_rollup(totals, guild_id, user_id, kind, key, start_time, end_time)
+                add_insights(hourly, members, guild_id, user_id, kind, key, start_time, end_time, horizon)
+                if kind in COUNTED_KINDS:
+                    add_counters(counters, guild_id, user_id, kind, key, start_time, end_time)
+            if len(totals) >= ROLLUP_FLUSH_SIZE:
+                write_rollups(session, totals)
+                totals = {}
+        write_rollups(session, totals)
+        write_insights(session, hourly, members)
+        write_counters(session, counters)
+
+        columns = [column for column in table.c if column.name not in ('id', 'guild_id')]
+        for guild_id, user_ids in copies.items():
+            for i in range(0, len(user_ids), QUERY_CHUNK):
+                session.execute(table.insert().from_select(
+                    ['guild_id'] + [column.name for column in columns],
+                    select(literal(guild_id), *columns).where(
+                        table.c.guild_id == None, table.c.user_id.in_(user_ids[i:i + QUERY_CHUNK])
+                    )
+                ))
+        for guild_id, user_ids in moves.items():
+            for i in range(0, len(user_ids), QUERY_CHUNK):
+                session.execute(table.update().where(
+                    table.c.guild_id == None, table.c.user_id.in_(user_ids[i:i + QUERY_CHUNK])
+                ).values(guild_id=guild_id))
+        session.commit()
+
+# Interval changes are written behind: tracking only enqueues them and a single
+# writer task flushes them in batches. The bounded queue applies backpressure to
+# tracking if the disk stalls instead of letting memory grow.
+WRITE_BATCH_SIZE = int(os.getenv('TRACKMAN_WRITE_BATCH_SIZE', 500))
+WRITE_FLUSH_INTERVAL = float(os.getenv('TRACKMAN_WRITE_FLUSH_INTERVAL', 2))
+WRITE_QUEUE_SIZE = int(os.getenv('TRACKMAN_WRITE_QUEUE_SIZE', 20000))
+WRITE_RETRIES = 5
+write_queue = asyncio.Queue(maxsize=WRITE_QUEUE_SIZE)
+flush_requested = asyncio.Event()
+writer_task = None
+# Batches committed so far, only advanced on the writer thread
+batches_written = 0
+
+def write_interval_batch(session, changes):
+    global batches_written
+    resolve_game_ids(session, [
+        value for change in changes if change.kind == 'game' for value in (change.closed_value, change.value) if value is not None
+    ])
+
+    inserts = {kind: {} for kind in TRACKED_KINDS}
+    closes = {kind: [] for kind in TRACKED_KINDS}
+    closed, opened = [], []
+    for change in changes:
+        model, column = TRACKED_KINDS[change.kind]
+        if change.closed_start:
+            closed.append((change.guild_id, change.user_id, change.kind, change.closed_value, change.closed_start, change.time))
+            # Intervals opened and closed within one batch are inserted already closed
+            pending = inserts[change.kind].get((change.guild_id, change.user_id, change.closed_start, change.closed_value))
+            if pending:
+                pending['end_time'] = change.time
+            else:
+                closes[change.kind].append({
+                    'b_guild_id': change.guild_id, 'b_user_id': change.user_id, 'b_value': stored_value(change.kind, change.closed_value),
+                    'b_start': change.closed_start, 'b_end': change.time
+                })
+        if change.value is not None:
+            opened.append((change.guild_id, change.user_id, change.kind, change.value, change.time))
+            inserts[change.kind][(change.guild_id, change.user_id, change.time, change.value)] = {
+                'guild_id': change.guild_id, 'user_id': change.user_id, column: stored_value(change.kind, change.value),
+                'start_time': change.time, 'end_time': None
+            }
+
+    for kind, (model, column) in TRACKED_KINDS.items():
+        table = model.__table__
+        if inserts[kind]:
+            bulk_insert(session, table, list(inserts[kind].values()))
+        if closes[kind]:
+            session.execute(
+                table.update().where(
+                    table.c.guild_id == bindparam('b_guild_id'),
+                    table.c.user_id == bindparam('b_user_id'),
+                    table.c[column] == bindparam('b_value'),
+                    table.c.start_time == bindparam('b_start'),
+                    table.c.end_time == None
+                ).values(end_time=bindparam('b_end')),
+                closes[kind]
+            )
+    marked = record_closed(session, closed, opened)
+    session.commit()
+    batches_written += 1
+    return batches_written, marked
+
+async def enqueue_changes(changes):
+    for change in changes:
+        if change:
+            await write_queue.put(change)
+
+async def interval_writer():
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await write_queue.get()]
+        deadline = loop.time() + WRITE_FLUSH_INTERVAL
+        while len(batch) < WRITE_BATCH_SIZE:
+            try:
+                batch.append(write_queue.get_nowait())
+                continue
+            except asyncio.QueueEmpty:
+                pass
+            if flush_requested.is_set() or loop.time() >= deadline:
+                break
+            try:
+                await asyncio.wait_for(flush_requested.wait(), min(0.1, deadline - loop.time()))
+            except asyncio.TimeoutError:
+                pass
+
+        for attempt in range(WRITE_RETRIES):
+            started = perf_counter()
+            try:
+                sequence, marked = await run_db(write_interval_batch, batch, write=True)
+            except Exception:
+                log.exception("Writing %d interval changes failed (attempt %d)", len(batch), attempt + 1)
+                count('trackman_write_failures_total')
+                await asyncio.sleep(2 ** attempt)
+                continue
+            observe('trackman_write_batch_seconds', perf_counter() - started)
+            count('trackman_interval_changes_total', len(batch))
+            update_rankings(batch, sequence)
+            update_insights(batch, sequence, marked)
+            break
+        else:
+            # Give up on this batch and resync the index with what actually got written
+            reset_open_intervals(await run_db(load_open_intervals, owned_guild_ids(), write=True))
+            ranked_indexes.clear()
+            ranked_lru.clear()
+            insights_indexes.clear()
+
+        for _ in batch:
+            write_queue.task_done()
+
+async def flush_writes():
+    if writer_task is None or writer_task.done():
+        return
+    flush_requested.set()
+    try:
+        await write_queue.join()
+    finally:
+        flush_requested.clear()
+
+def close_intervals(key, now):
+    # now may be in the past when closing at a disconnect, but never before the start
+    guild_id, user_id, kind = key
+    return [
+        IntervalChange(kind, guild_id, user_id, start_time, value, None, max(start_time, now))
+        for value, start_time in pop_open_intervals(key).items()
+    ]
+
+# Compact copy of what tracking reads from members, fed by gateway events so
+# discord.py doesn't have to cache members at all. member_states maps guild id to
+# user id to MemberState; statuses are stored as an index into STATUSES, and the
+# games being played and voice states as interned tuples, so everyone playing
+# the same games shares one tuple.
+STATUSES = ('online', 'idle', 'dnd', 'offline')
+STATUS_CODES = {status: code for code, status in enumerate(STATUSES)}
+OFFLINE = STATUS_CODES['offline']
+VOICE_STATES = ('muted', 'deafened', 'streaming', 'video')
+
+class MemberState:
+    __slots__ = ('status', 'games', 'channel_id', 'voice_states')
+
+    def __init__(self):
+        self.status = OFFLINE
+        self.games = ()
+        self.channel_id = None
+        self.voice_states = ()
+
+member_states = {}
+interned_tuples = {}
+bot_ids = set()
+
+def member_state(guild_id, user_id):
+    members = member_states.setdefault(guild_id, {})
+    member = members.get(user_id)
+    if member is None:
+        member = members[user_id] = MemberState()
+    return member
+
+def intern_tuple(values):
+    values = tuple(sys.intern(value) for value in values)
+    return interned_tuples.setdefault(values, values)
+
+def set_presence(member, status, games):
+    member.status = STATUS_CODES.get(status, OFFLINE)
+    member.games = intern_tuple(games)
+
+def set_voice(member, channel_id, muted, deafened, streaming, video):
+    member.channel_id = channel_id
+    flags = (muted, deafened, streaming, video) if channel_id else ()
+    member.voice_states = intern_tuple(state for state, flag in zip(VOICE_STATES, flags) if flag)
+
+def seed_member_states(data):
+    if data.get('unavailable'):
+        return
+
+    # A guild is sent again in full after a reconnect, so anyone missing from it
+    # has gone offline and left voice
+    guild_id = int(data['id'])
+    members = member_states.setdefault(guild_id, {})
+    for member in members.values():
+        member.status, member.games, member.channel_id, member.voice_states = OFFLINE, (), None, ()
+
+    for member_data in data.get('members', []):
+        if member_data['user'].get('bot'):
+            bot_ids.add(int(member_data['user']['id']))
+    for presence in data.get('presences', []):
+        games = dict.fromkeys(activity['name'] for activity in presence.get('activities') or [] if activity.get('type') == 0)
+        set_presence(member_state(guild_id, int(presence['user']['id'])), presence['status'], games)
+    for voice in data.get('voice_states', []):
+        set_voice(
+            member_state(guild_id, int(voice['user_id'])), int(voice['channel_id']) if voice.get('channel_id') else None,
+            voice.get('self_mute') or voice.get('mute'), voice.get('self_deaf') or voice.get('deaf'),
+            voice.get('self_stream'), voice.get('self_video')
+        )
+
+def playing_games(activities):
+    # Every game the member is playing, not just their primary activity
+    return dict.fromkeys(activity.name for activity in activities if activity.type == discord.ActivityType.playing)
+
+def current_state(member, settings):
+    state = {}
+    if settings.track_status:
+        state['status'] = (STATUSES[member.status],)
+    if settings.track_games:
+        state['game'] = member.games
+    if settings.track_voice:
+        state['voice'] = (str(member.channel_id),) if member.channel_id else ()
+        if settings.track_voice_states:
+            state['voice_state'] = member.voice_states
+    return state
+
+def update_intervals(kind, guild_id, user_id, values, now):
+    key = (guild_id, user_id, kind)
+    intervals = open_intervals.get(key, {})
+    closing = [value for value in intervals if value not in values]
+    opening = [value for value in values if value not in intervals]
+    if not closing and not opening:
+        return []
+
+    # A switch, e.g. between statuses, closes one interval and opens the next in
+    # a single change
+    changes = [
+        IntervalChange(kind, guild_id, user_id, intervals.get(closed), closed, value, now)
+        for closed, value in zip_longest(closing, opening)
+    ]
+    intervals = {value: start_time for value, start_time in intervals.items() if value in values}
+    intervals.update((value, now) for value in opening)
+    set_open_intervals(key, intervals)
+    return changes
+
+def sync_member(guild_id, user_id, member, settings, kinds=None):
+    now = datetime.utcnow()
+    changes = []
+    for kind, values in current_state(member, settings).items():
+        if kinds is None or kind in kinds:
+            changes.extend(update_intervals(kind, str(guild_id), str(user_id), values, now))
+    return changes
+
+async def track_member_change(guild_id, user_id, kinds):
+    # Anything before the index is loaded is picked up by the first reconciliation
+    if user_id == TRACKMAN_ID or user_id in bot_ids or not index_loaded.is_set():
+        return
+
+    settings = get_settings(str(guild_id))
+    if settings:
+        await enqueue_changes(sync_member(guild_id, user_id, member_states[guild_id][user_id], settings, kinds))
+
+@bot.event
+async def on_raw_presence_update(payload):
+    if payload.guild_id is None:
+        return
+
+    member = member_state(payload.guild_id, payload.user_id)
+    status, games = member.status, member.games
+    set_presence(member, payload.client_status.raw_status, playing_games(payload.activities))
+
+    kinds = []
+    if member.status != status:
+        kinds.append('status')
+    if member.games != games:
+        kinds.append('game')
+    if kinds:
+        await track_member_change(payload.guild_id, payload.user_id, kinds)
+
+@bot.event
+async def on_voice_state_update(member, before, after):
+    if member.bot:
+        bot_ids.add(member.id)
+
+    # Every move between channels closes one interval and opens the next
+    state = member_state(member.guild.id, member.id)
+    channel_id, voice_states = state.channel_id, state.voice_states
+    set_voice(
+        state, after.channel.id if after.channel else None,
+        after.self_mute or after.mute, after.self_deaf or after.deaf, after.self_stream, after.self_video
+    )
+
+    kinds = []
+    if state.channel_id != channel_id:
+        kinds.append('voice')
+    if state.voice_states != voice_states:
+        kinds.append('voice_state')
+    if kinds:
+        await track_member_change(member.guild.id, member.id, kinds)
+
+@bot.event
+async def on_member_join(member):
+    if member.bot:
+        bot_ids.add(member.id)
+    departed_members.discard((member.guild.id, str(member.id)))
+
+@bot.event
+async def on_raw_member_remove(payload):
+    # Their open intervals are closed by the next reconciliation
+    member_states.get(payload.guild_id, {}).pop(payload.user.id, None)
+
+@bot.event
+async def on_shard_resumed(shard_id):
+    # Events may have been dropped while the shard's gateway was away
+    bot.loop.create_task(resync_shard(shard_id))
+
+@bot.event
+async def on_shard_ready(shard_id):
+    # A shard that had to identify again starts from a fresh GUILD_CREATE
+    if index_loaded.is_set():
+        bot.loop.create_task(resync_shard(shard_id))
+
+async def reconcile_activities(shard_id=None):
+    async with reconcile_locks.setdefault(shard_id, asyncio.Lock()):
+        started = perf_counter()
+        seen = set()
+        guild_ids = set()
+        for guild in shard_guilds(shard_id):
+            guild_ids.add(str(guild.id))
+            settings = get_settings(str(guild.id))
             if not settings:
                 continue
 
-            for member in guild.members:
-                if member.id == TRACKMAN_ID:
-                    continue
+            changes = []
+            for user_id, member in list(member_states.get(guild.id, {}).items()):
+                if user_id == TRACKMAN_ID or user_id in bot_ids:
+                    continue
+
+                changes.extend(sync_member(guild.id, user_id, member, settings))
+                seen.update((str(guild.id), str(user_id), kind) for kind in current_state(member, settings))
+
+            await enqueue_changes(changes)
+
+        # Members who left, guilds we left, or kinds a server stopped tracking, must
+        # not stay open forever. Other shards' guilds are left to their own sweep.
+        present = set(owned_guild_ids())
+        now = datetime.utcnow()
+        await enqueue_changes([
+            change
+            for guild_id in [guild_id for guild_id in guild_interval_keys if guild_id in guild_ids or guild_id not in present]
+            for key in [key for key in guild_interval_keys[guild_id] if key not in seen]
+            for change in close_intervals(key, now)
+        ])
+        observe('trackman_sweep_seconds', perf_counter() - started, shard='all' if shard_id is None else str(shard_id))
+
+async def track_activities(shard_id):
+    while True:
+        await reconcile_activities(shard_id)
+        await asyncio.sleep(RECONCILE_INTERVAL)
+
+# Recovery. Nothing is known about members while the process is down or a
+# shard is disconnected, so that time must not count as activity. A heartbeat
+# row records when this process last had a full view; on startup every interval
+# still open is closed there, and a shard away for longer than GAP_TOLERANCE has
+# its intervals closed at the disconnect. Reconciliation then reopens whatever
+# is current.
+HEARTBEAT_INTERVAL = 60
+GAP_TOLERANCE = 60
+HEARTBEAT_PROCESS = ','.join(str(shard_id) for shard_id in SHARD_IDS) if SHARD_IDS else 'all'
+disconnected_at = {}
+
+def last_seen():
+    return min(disconnected_at.values(), default=datetime.utcnow())
+
+def write_heartbeat(session, seen):
+    stmt = upsert(Heartbeat.__table__)
+    session.execute(stmt.on_conflict_do_update(index_elements=['process'], set_={'last_seen': stmt.excluded.last_seen}), [
+        {'process': HEARTBEAT_PROCESS, 'last_seen': seen}
+    ])
+    session.commit()
+
+def last_heartbeat(session):
+    seen = session.query(Heartbeat.last_seen).filter(Heartbeat.process == HEARTBEAT_PROCESS).scalar()
+    if seen:
+        return seen
+    # The shards were split differently last time, or the database predates
+    # heartbeats; the latest heartbeat or interval write is the best guess
+    candidates = [session.query(func.max(Heartbeat.last_seen)).scalar()]
+    for model in ACTIVITY_MODELS:
+        candidates.append(session.query(func.max(model.start_time)).scalar())
+        candidates.append(session.query(func.max(model.end_time)).scalar())
+    return max([candidate for candidate in candidates if candidate], default=None)
+
+def recover_intervals(session, guild_ids, seen):
+    # guild_ids is None when this process owns every guild, including ones it
+    # has since left
+    closed = []
+    for kind, (model, column) in TRACKED_KINDS.items():
+        table = model.__table__
+        scopes = [table.c.guild_id != None] if guild_ids is None else [
+            table.c.guild_id.in_(guild_ids[i:i + QUERY_CHUNK]) for i in range(0, len(guild_ids), QUERY_CHUNK)
+        ]
+        for scope in scopes:
+            rows = session.execute(select_intervals(kind, 'guild_id', 'user_id', 'value', 'start_time').where(table.c.end_time == None, scope))
+            closed.extend((guild_id, user_id, kind, value, start_time, max(start_time, seen)) for guild_id, user_id, value, start_time in rows)
+            session.execute(table.update().where(table.c.end_time == None, scope).values(
+                end_time=case((table.c.start_time > seen, table.c.start_time), else_=seen)
+            ))
+    # Badge streaks expect each user's intervals in order
+    closed.sort(key=lambda interval: (interval[0], interval[1], interval[4]))
+    record_closed(session, closed)
+    session.commit()
+    return len(closed)
+
+async def resync_shard(shard_id):
+    since = disconnected_at.pop(shard_id, None)
+    if since and (datetime.utcnow() - since).total_seconds() > GAP_TOLERANCE:
+        guild_ids = {str(guild.id) for guild in shard_guilds(shard_id)}
+        await enqueue_changes([
+            change
+            for guild_id in guild_ids
+            for key in list(guild_interval_keys.get(guild_id, ()))
+            for change in close_intervals(key, since)
+        ])
+        log.info("Shard %d was away since %s; closed its open intervals there", shard_id, since)
+    await reconcile_activities(shard_id)
+
+async def heartbeat_loop():
+    while True:
+        try:
+            await run_db(write_heartbeat, last_seen(), write=True)
+        except Exception:
+            log.exception("Writing the heartbeat failed")
+        await asyncio.sleep(HEARTBEAT_INTERVAL)
+
+# Raw intervals are only needed until they close; rollups and badge counters are
+# written in the same transaction, so closed rows past the horizon are deleted
+# in short chunks that interleave with interval writes, and the freed pages are
+# handed back to the filesystem. Daily rollups past the horizon are folded into
+# one all-time row per key, dated ALL_TIME_DAY, which only the 'all' window
+# reads; windows reach back 30 days at most, so those days are kept regardless.
+# Insights rollups are simply dropped past INSIGHTS_ROLLUP_DAYS.
+RETENTION_DAYS = int(os.getenv('TRACKMAN_RETENTION_DAYS', 90))
+DAILY_ROLLUP_DAYS = max(RETENTION_DAYS, 31)
+ALL_TIME_DAY = date(1970, 1, 1)
+RETENTION_INTERVAL = 6 * 60 * 60
+RETENTION_CHUNK = 2000
+RETENTION_PAUSE = 0.1
+VACUUM_PAGES = 2000
+
+def delete_expired_rows(session, model, cutoff):
+    # Rows without a guild were never rolled up and are kept for backfill
+    table = model.__table__
+    expired = select(table.c.id).where(
+        table.c.guild_id != None,
+        table.c.end_time != None,
+        table.c.end_time < cutoff
+    ).limit(RETENTION_CHUNK)
+    deleted = session.execute(table.delete().where(table.c.id.in_(expired))).rowcount
+    session.commit()
+    return deleted
+
+def delete_expired_insights(session, column, cutoff):
+    table = column.table
+    expired = select(table.c.id).where(column < cutoff).limit(RETENTION_CHUNK)
+    deleted = session.execute(table.delete().where(table.c.id.in_(expired))).rowcount
+    session.commit()
+    return deleted
+
+def compact_rollups(session, cutoff_day):
+    table = ActivityRollup.__table__
+    rows = session.execute(select(
+        table.c.id, table.c.guild_id, table.c.user_id, table.c.kind, table.c.key, table.c.seconds
+    ).where(
+        table.c.day < cutoff_day,
+        table.c.day != ALL_TIME_DAY
+    ).limit(RETENTION_CHUNK)).all()
+    totals = {}
+    for _, guild_id, user_id, kind, key, seconds in rows:
+        rollup_key = (guild_id, user_id, kind, ALL_TIME_DAY, key)
+        totals[rollup_key] = totals.get(rollup_key, 0) + seconds
+    session.execute(table.delete().where(table.c.id.in_([row[0] for row in rows])))
+    write_rollups(session, totals)
+    session.commit()
+    return len(rows)
+
+def incremental_vacuum(session):
+    # sqlite3 steps a PRAGMA only once, which frees a single page; executescript
+    # runs it to completion
+    session.connection().connection.driver_connection.executescript(f'PRAGMA incremental_vacuum({VACUUM_PAGES})')
+    return session.execute(text('PRAGMA freelist_count')).scalar()
+
+async def prune_history():
+    cutoff = datetime.utcnow() - timedelta(days=RETENTION_DAYS)
+    deleted = 0
+    for model in ACTIVITY_MODELS:
+        while True:
+            count = await run_db(delete_expired_rows, model, cutoff, write=True)
+            deleted += count
+            if count < RETENTION_CHUNK:
+                break
+            await asyncio.sleep(RETENTION_PAUSE)
+
+    cutoff_day = (datetime.utcnow() - timedelta(days=DAILY_ROLLUP_DAYS)).date()
+    compacted = 0
+    while True:
+        count = await run_db(compact_rollups, cutoff_day, write=True)
+        compacted += count
+        if count < RETENTION_CHUNK:
+            break
+        await asyncio.sleep(RETENTION_PAUSE)
+
+    horizon = insights_horizon()
+    for column, cutoff in ((ActivityHourly.__table__.c.hour, horizon), (ActiveMember.__table__.c.day, horizon.date())):
+        while await run_db(delete_expired_insights, column, cutoff, write=True) == RETENTION_CHUNK:
+            await asyncio.sleep(RETENTION_PAUSE)
+
+    # Postgres reclaims space through autovacuum
+    free_pages, previous = (await run_db(incremental_vacuum, write=True) if SQLITE else 0), None
+    while free_pages and free_pages != previous:
+        await asyncio.sleep(RETENTION_PAUSE)
+        free_pages, previous = await run_db(incremental_vacuum, write=True), free_pages
+    log.info("Retention removed %d intervals that ended before %s and compacted %d daily rollups", deleted, cutoff, compacted)
+
+async def retention_loop():
+    while True:
+        try:
+            await prune_history()
+        except Exception:
+            log.exception("Pruning history failed")
+        await asyncio.sleep(RETENTION_INTERVAL)
+
+# Export and import. Intervals are streamed to and from gzipped CSV or NDJSON,
+# one row per interval, so neither side holds a guild's history in memory.
+# Exports read from a single snapshot while the tracker keeps writing; imports
+# only take closed intervals and roll them up like the tracker would.
+EXPORT_FORMATS = ('csv', 'ndjson')
+EXPORT_FIELDS = ('kind', 'guild_id', 'user_id', 'value', 'start_time', 'end_time')
+EXPORT_CHUNK = 5000
+EXPORT_DIR = os.getenv('TRACKMAN_EXPORT_DIR', 'exports')
+IMPORT_BATCH = 20000
+IMPORT_POLL_INTERVAL = 60
+rollup_versions = {}
+
+@contextmanager
+def snapshot():
+    with engine.connect() as conn:
+        if SQLITE:
+            # pysqlite only opens a transaction before writes, and without one
+            # every SELECT sees the database as it is at that moment
+            conn.exec_driver_sql('BEGIN')
+        else:
+            conn = conn.execution_options(isolation_level='REPEATABLE READ')
+        yield conn
+
+def export_rows(conn, guild_id=None):
+    for kind, (model, column) in TRACKED_KINDS.items():
+        table = model.__table__
+        stmt = select_intervals(kind, 'guild_id', 'user_id', 'value', 'start_time', 'end_time').where(
+            table.c.guild_id == guild_id if guild_id else table.c.guild_id != None
+        )
+        for rows in conn.execute(stmt.execution_options(stream_results=True, yield_per=EXPORT_CHUNK)).partitions():
+            for row in rows:
+                yield (kind, *row)
+
+def export_intervals(path, fmt, guild_id=None):
+    exported = 0
+    with snapshot() as conn, gzip.open(path, 'wt', newline='') as file:
+        writer = csv.writer(file)
+        if fmt == 'csv':
+            writer.writerow(EXPORT_FIELDS)
+        for kind, row_guild_id, user_id, value, start_time, end_time in export_rows(conn, guild_id):
+            row = (kind, row_guild_id, user_id, value, start_time.isoformat(), end_time.isoformat() if end_time else None)
+            if fmt == 'csv':
+                writer.writerow(row)
+            else:
+                file.write(json.dumps(dict(zip(EXPORT_FIELDS, row))) + "\n")
+            exported += 1
+    return exported
+
+def read_export(path):
+    # Told apart by the first line rather than the name: NDJSON rows are
+    # objects, CSV starts with its header
+    with gzip.open(path, 'rt', newline='') as file:
+        first = file.readline()
+        lines = chain([first], file)
+        rows = map(json.loads, lines) if first.startswith('{') else csv.DictReader(lines)
+        for row in rows:
+            yield row
+
+def import_batch(session, batch):
+    resolve_game_ids(session, {row['value'] for row in batch if row['kind'] == 'game'})
+    for kind, (model, column) in TRACKED_KINDS.items():
+        rows = [
+            {'guild_id': row['guild_id'], 'user_id': row['user_id'], column: stored_value(kind, row['value']), 'start_time': row['start_time'], 'end_time': row['end_time']}
+            for row in batch if row['kind'] == kind
+        ]
+        if rows:
+            bulk_insert(session, model.__table__, rows)
+    # Badge streaks expect each user's intervals in order
+    record_closed(session, sorted(
+        [(row['guild_id'], row['user_id'], row['kind'], row['value'], row['start_time'], row['end_time']) for row in batch],
+        key=lambda interval: (interval[0], interval[1], interval[4])
+    ))
+    table = RollupVersion.__table__
+    stmt = upsert(table)
+    session.execute(stmt.on_conflict_do_update(index_elements=['guild_id'], set_={'version': table.c.version + 1}), [
+        {'guild_id': guild_id, 'version': 1} for guild_id in {row['guild_id'] for row in batch}
+    ])
+    session.commit()
+
+def import_intervals(path):
+    # Intervals still open in the export belong to the tracker that wrote them
+    imported, skipped, batch = 0, 0, []
+    session = Session()
+    try:
+        for row in read_export(path):
+            if row['kind'] not in TRACKED_KINDS or not row['guild_id'] or not row['end_time']:
+                skipped += 1
+                continue
+            row['start_time'], row['end_time'] = datetime.fromisoformat(row['start_time']), datetime.fromisoformat(row['end_time'])
+            batch.append(row)
+            if len(batch) >= IMPORT_BATCH:
+                import_batch(session, batch)
+                imported, batch = imported + len(batch), []
+        if batch:
+            import_batch(session, batch)
+            imported += len(batch)
+    finally:
+        session.close()
+    return imported, skipped
+
+def load_rollup_versions(session):
+    return dict(session.query(RollupVersion.guild_id, RollupVersion.version))
+
+def drop_guild_indexes(guild_id):
+    for category, days in ranked_indexes.pop(guild_id, {}):
+        ranked_lru.pop((guild_id, category, days), None)
+    insights_indexes.pop(guild_id, None)
+    invalidate_results(guild_id)
+
+async def import_poll_loop():
+    # Imports run in their own process; the ranked and insights indexes of the
+    # guilds they touched are rebuilt from the rollups on next use
+    while True:
+        await asyncio.sleep(IMPORT_POLL_INTERVAL)
+        try:
+            versions = await run_db(load_rollup_versions)
+        except Exception:
+            log.exception("Reading rollup versions failed")
+            continue
+        for guild_id, version in versions.items():
+            if rollup_versions.get(guild_id) != version:
+                rollup_versions[guild_id] = version
+                drop_guild_indexes(guild_id)
+                log.info("Reloading leaderboards and insights for guild %s after an import", guild_id)
+
+# Badges are evaluated for a whole guild at once on their own schedule,
+# separately from interval tracking
+BADGE_INTERVAL = 30 * 60
+
+# Each badge either reads a running counter or sums a kind over a recent
+# window of rollups; tiers are the value needed, in days for streaks and hours
+# otherwise
+BADGE_RULES = {
+    'Online Streaker': {'counter': 'online_streak', 'tiers': [('Bronze', 7), ('Silver', 14), ('Gold', 30), ('Platinum', 60)]},
+    'Night Owl': {'counter': 'night_hours', 'tiers': [('Bronze', 10), ('Silver', 50), ('Gold', 100)]},
+    'Chatterbox': {'kind': 'voice', 'days': 30, 'tiers': [('Bronze', 10), ('Silver', 25), ('Gold', 50), ('Platinum', 100)]},
+    'Game Addict': {'counter': 'game_hours', 'tiers': [('Bronze', 25), ('Silver', 100), ('Gold', 250), ('Platinum', 500)]},
+}
+
+def guild_counters(session, guild_id):
+    return {
+        (guild_id, user_id, counter): (value, last_day)
+        for user_id, counter, value, last_day in session.query(
+            BadgeCounter.user_id, BadgeCounter.counter, BadgeCounter.value, BadgeCounter.last_day
+        ).filter(BadgeCounter.guild_id == guild_id)
+    }
+
+def guild_window_seconds(session, guild_id, kind, since_day):
+    return session.query(ActivityRollup.user_id, func.sum(ActivityRollup.seconds)).filter(
+        ActivityRollup.guild_id == guild_id,
+        ActivityRollup.kind == kind,
+        ActivityRollup.day.in_(window_days(since_day))
+    ).group_by(ActivityRollup.user_id).all()
+
+async def badge_values(guild_id, now):
+    # Still-open intervals aren't counted yet; treat them as closing now
+    counters = await run_db(guild_counters, guild_id)
+    for key in list(guild_interval_keys.get(guild_id, ())):
+        _, user_id, kind = key
+        if kind in COUNTED_KINDS:
+            for value, start_time in open_intervals[key].items():
+                add_counters(counters, guild_id, user_id, kind, value, start_time, now)
+
+    values = {}
+    for badge_name, rule in BADGE_RULES.items():
+        if 'counter' in rule:
+            values[badge_name] = {
+                user_id: value for (_, user_id, counter), (value, _) in counters.items() if counter == rule['counter']
+            }
+        else:
+            since = window_start(rule['days'], now)
+            hours = {user_id: seconds / 3600 for user_id, seconds in await run_db(guild_window_seconds, guild_id, rule['kind'], since.date())}
+            for user_id, _, seconds in live_totals(guild_id, rule['kind'], since, now):
+                hours[user_id] = hours.get(user_id, 0) + seconds / 3600
+            values[badge_name] = hours
+    return values
+
+# (guild_id, user_id, badge, tier) already checked against the member's roles,
+# so members are only fetched when they may have earned something new
+awarded_badges = set()
+# (guild_id, user_id) of members the gateway didn't return, who have left the
+# guild; they aren't fetched again unless they rejoin
+departed_members = set()
+
+async def fetch_members(guild, user_ids):
+    # Members aren't cached; the gateway returns up to 100 per request
+    members = []
+    for i in range(0, len(user_ids), 100):
+        members.extend(await guild.query_members(user_ids=user_ids[i:i + 100], limit=100, cache=False))
+    return members
+
+async def evaluate_guild_badges(guild):
+    values = await badge_values(str(guild.id), datetime.utcnow())
+
+    earned = {}
+    for badge_name, rule in BADGE_RULES.items():
+        for user_id, value in values[badge_name].items():
+            if int(user_id) == TRACKMAN_ID or int(user_id) in bot_ids or (guild.id, user_id) in departed_members:
+                continue
+            for badge_tier, threshold in rule['tiers']:
+                if value >= threshold and (guild.id, user_id, badge_name, badge_tier) not in awarded_badges:
+                    earned.setdefault(user_id, []).append((badge_name, badge_tier))
+
+    members = await fetch_members(guild, [int(user_id) for user_id in earned])
+    departed_members.update((guild.id, user_id) for user_id in earned.keys() - {str(member.id) for member in members})
+    for member in members:
+        if member.bot:
+            bot_ids.add(member.id)
+            continue
+
+        held = {role.name for role in member.roles}
+        for badge_name, badge_tier in earned[str(member.id)]:
+            if BADGES[badge_name][badge_tier] not in held:
+                await award_badge(member, badge_name, badge_tier)
+            awarded_badges.add((guild.id, str(member.id), badge_name, badge_tier))
+
+# Guilds that refused us Manage Roles or role hierarchy, skipped until their
+# roles change
+badge_forbidden = set()
+
+async def evaluate_badges():
+    for guild in bot.guilds:
+        settings = get_settings(str(guild.id))
+        if not settings or not settings.use_badges or guild.id in badge_forbidden:
+            continue
+        try:
+            await evaluate_guild_badges(guild)
+        except discord.Forbidden:
+            log.warning("Missing permissions to award badges in guild %d; skipping it until its roles change", guild.id)
+            badge_forbidden.add(guild.id)
+        except Exception:
+            log.exception("Evaluating badges for guild %d failed", guild.id)
+
+async def badge_loop():
+    while True:
+        await asyncio.sleep(BADGE_INTERVAL)
+        await evaluate_badges()
+
+# Badge roles per guild, keyed by (badge, tier); dropped whenever the guild's
+# roles change and rebuilt from guild.roles on next use
+badge_roles = {}
+role_creations = {}
+BADGE_ROLE_NAMES = {
+    role_name: (badge_name, badge_tier)
+    for badge_name, tiers in BADGES.items()
+    for badge_tier, role_name in tiers.items()
+}
+
+def invalidate_badge_roles(guild):
+    badge_roles.pop(guild.id, None)
+    badge_forbidden.discard(guild.id)
 
-                if settings.track_status:
-                    current_status = str(member.status)
-                    existing_activity = session.query(UserActivity).filter_by(
-                        user_id=str(member.id), end_time=None
-                    ).first()
-                    
-                    if existing_activity:
-                        if existing_activity.status != current_status:
-                            existing_activity.end_time = datetime.utcnow()
-                            session.add(UserActivity(user_id=str(member.id), status=current_status, start_time=datetime.utcnow()))
-                    else:
-                        session.add(UserActivity(user_id=str(member.id), status=current_status, start_time=datetime.utcnow()))
-
-                if settings.track_games:
-                    if member.activity and member.activity.type == discord.ActivityType.playing:
-                        game = member.activity.name
-                        existing_game = session.query(GameActivity).filter_by(
-                            user_id=str(member.id), end_time=None
-                        ).first()
-                        
-                        if existing_game:
-                            if existing_game.game != game:
-                                existing_game.end_time = datetime.utcnow()
-                                session.add(GameActivity(user_id=str(member.id), game=game, start_time=datetime.utcnow()))
-                        else:
-                            session.add(GameActivity(user_id=str(member.id), game=game, start_time=datetime.utcnow()))
-
-                if settings.track_voice:
-                    if member.voice:
-                        existing_voice = session.query(VoiceActivity).filter_by(
-                            user_id=str(member.id), end_time=None
-                        ).first()
-                        
-                        if not existing_voice:
-                            session.add(VoiceActivity(user_id=str(member.id), channel_id=str(member.voice.channel.id), start_time=datetime.utcnow()))
-                    elif not member.voice:
-                        existing_voice = session.query(VoiceActivity).filter_by(
-                            user_id=str(member.id), end_time=None
-                        ).first()
-                        if existing_voice:
-                            existing_voice.end_time = datetime.utcnow()
-
-                if settings.use_badges:
-                    await check_and_award_badges(member)
+@bot.event
+async def on_guild_role_create(role):
+    invalidate_badge_roles(role.guild)
 
-        session.commit()
-        session.close()
-        await asyncio.sleep(60)  # Update every minute
+@bot.event
+async def on_guild_role_delete(role):
+    invalidate_badge_roles(role.guild)
 
-async def check_and_award_badges(member):
-    session = Session()
-    settings = session.query(ServerSettings).filter_by(server_id=str(member.guild.id)).first()
-    
-    if not settings or not settings.use_badges:
-        session.close()
-        return
+@bot.event
+async def on_guild_role_update(before, after):
+    invalidate_badge_roles(after.guild)
+    invalidate_announcement_channel(after.guild)
+
+async def get_badge_role(guild, badge_name, badge_tier):
+    roles = badge_roles.get(guild.id)
+    if roles is None:
+        roles = badge_roles[guild.id] = {
+            BADGE_ROLE_NAMES[role.name]: role for role in guild.roles if role.name in BADGE_ROLE_NAMES
+        }
 
-    week_ago = datetime.utcnow() - timedelta(days=7)
-    month_ago = datetime.utcnow() - timedelta(days=30)
-
-    # Check Online Streaker badge
-    online_days = session.query(func.count(func.distinct(func.date(UserActivity.start_time)))).filter(
-        UserActivity.user_id == str(member.id),
-        UserActivity.status == 'online',
-        UserActivity.start_time >= week_ago
-    ).scalar()
-
-    if online_days >= 7:
-        await award_badge(member, 'Online Streaker', 'Bronze')
-    if online_days >= 14:
-        await award_badge(member, 'Online Streaker', 'Silver')
-    if online_days >= 30:
-        await award_badge(member, 'Online Streaker', 'Gold')
-
-    # Check Chatterbox badge
-    voice_time = session.query(func.sum(func.julianday(func.coalesce(VoiceActivity.end_time, func.current_timestamp())) - func.julianday(VoiceActivity.start_time)) * 24).filter(
-        VoiceActivity.user_id == str(member.id),
-        VoiceActivity.start_time >= month_ago
-    ).scalar() or 0
-
-    if voice_time >= 10:
-        await award_badge(member, 'Chatterbox', 'Bronze')
-    if voice_time >= 25:
-        await award_badge(member, 'Chatterbox', 'Silver')
-    if voice_time >= 50:
-        await award_badge(member, 'Chatterbox', 'Gold')
-    if voice_time >= 100:
-        await award_badge(member, 'Chatterbox', 'Platinum')
-
-    session.close()
+    role = roles.get((badge_name, badge_tier))
+    if role:
+        return role
+
+    # Concurrent callers share a single create_role so the role is never duplicated
+    key = (guild.id, badge_name, badge_tier)
+    creation = role_creations.get(key)
+    if creation is None:
+        creation = role_creations[key] = asyncio.ensure_future(guild.create_role(name=BADGES[badge_name][badge_tier]))
+        creation.add_done_callback(lambda _: role_creations.pop(key, None))
+    role = await asyncio.shield(creation)
+    badge_roles.setdefault(guild.id, {})[(badge_name, badge_tier)] = role
+    return role
 
 async def award_badge(member, badge_name, badge_tier):
-    role_name = BADGES[badge_name][badge_tier]
-    role = discord.utils.get(member.guild.roles, name=role_name)
-    
-    if not role:
-        # Create the role if it doesn't exist
-        role = await member.guild.create_role(name=role_name)
-    
+    role = await get_badge_role(member.guild, badge_name, badge_tier)
+
     if role not in member.roles:
         await member.add_roles(role)
         await send_badge_notification(member, badge_name, badge_tier)
 
+# Badge notifications are queued and sent by one task that waits a moment to
+# gather bursts, then sends one combined message per destination
+NOTIFICATION_DELAY = 2
+MAX_MESSAGE_LENGTH = 2000
+notifications = asyncio.Queue(maxsize=1000)
+
 async def send_badge_notification(member, badge_name, badge_tier):
     message = f"🎉 Congratulations, {member.mention}! You've earned the {badge_name} ({badge_tier}) badge!"
-    
-    session = Session()
-    settings = session.query(ServerSettings).filter_by(server_id=str(member.guild.id)).first()
-    
+
+    settings = get_settings(str(member.guild.id))
+
     if settings and settings.notification_channel_id:
         channel = member.guild.get_channel(int(settings.notification_channel_id))
         if channel:
-            await channel.send(message)
+            await notifications.put((channel, message))
     else:
-        await member.send(message)
-    
-    session.close()
+        await notifications.put((member, message))
+
+def combine_messages(messages):
+    combined = ''
+    for message in messages:
+        if combined and len(combined) + len(message) + 1 > MAX_MESSAGE_LENGTH:
+            yield combined
+            combined = ''
+        combined = f"{combined}\n{message}" if combined else message
+    if combined:
+        yield combined
+
+async def notification_sender():
+    while True:
+        pending = [await notifications.get()]
+        await asyncio.sleep(NOTIFICATION_DELAY)
+        while not notifications.empty():
+            pending.append(notifications.get_nowait())
+
+        by_target = {}
+        for target, message in pending:
+            by_target.setdefault(target, []).append(message)
+
+        for target, messages in by_target.items():
+            for message in combine_messages(messages):
+                try:
+                    await target.send(message)
+                except discord.HTTPException:
+                    log.exception("Sending a badge notification to %s failed", target)
+
+def save_settings(session, settings):
+    session.add(settings)
+    session.commit()
+    return settings
+
+TOGGLE_FEATURES = {
+    'status': 'track_status',
+    'games': 'track_games',
+    'voice': 'track_voice',
+    'voicestates': 'track_voice_states',
+    'badges': 'use_badges',
+    'startup': 'announce_start',
+    'shutdown': 'announce_stop',
+    'errors': 'announce_errors',
+}
+
+def toggle_setting(session, server_id, column):
+    settings = fetch_settings(session, server_id)
+    if settings and column:
+        setattr(settings, column, not getattr(settings, column))
+        session.commit()
+    return settings
+
+def set_notification_channel(session, server_id, channel_id):
+    settings = fetch_settings(session, server_id)
+    if settings:
+        settings.notification_channel_id = channel_id
+        session.commit()
+    return settings
 
 @bot.command()
 @commands.has_permissions(administrator=True)
 async def setup(ctx):
-    session = Session()
-    settings = session.query(ServerSettings).filter_by(server_id=str(ctx.guild.id)).first()
+    settings = get_settings(str(ctx.guild.id))
     
     if settings:
         await ctx.send("This server is already set up. Use `=config` to modify settings.")
@@ -281,22 +1950,18 @@ async def setup(ctx):
         use_badges=enabled_features[3],
         notification_channel_id=str(notification_channel.id) if notification_channel else None
     )
-    session.add(new_settings)
-    session.commit()
+    cache_settings(await run_db(save_settings, new_settings))
 
     await ctx.send("Setup complete! Use `=config` to modify settings later.")
 
     # Create badge roles if badge system is enabled
     if enabled_features[3]:
-        await create_badge_roles(ctx.guild)
-
-    session.close()
+        await create_badge_roles(ctx)
 
 @bot.command()
 @commands.has_permissions(administrator=True)
 async def config(ctx):
-    session = Session()
-    settings = session.query(ServerSettings).filter_by(server_id=str(ctx.guild.id)).first()
+    settings = get_settings(str(ctx.guild.id))
     
     if not settings:
         await ctx.send("This server hasn't been set up yet. Use `=setup` to configure the bot.")
@@ -306,61 +1971,76 @@ async def config(ctx):
     embed.add_field(name="Status Tracking", value="Enabled" if settings.track_status else "Disabled", inline=False)
     embed.add_field(name="Game Tracking", value="Enabled" if settings.track_games else "Disabled", inline=False)
     embed.add_field(name="Voice Tracking", value="Enabled" if settings.track_voice else "Disabled", inline=False)
+    embed.add_field(name="Voice State Tracking", value="Enabled" if settings.track_voice_states else "Disabled", inline=False)
     embed.add_field(name="Badge System", value="Enabled" if settings.use_badges else "Disabled", inline=False)
     embed.add_field(name="Notification Channel", value=f"<#{settings.notification_channel_id}>" if settings.notification_channel_id else "Not set", inline=False)
+    embed.add_field(name="Announcements", value=", ".join(
+        name for name, column in (("Startup", 'announce_start'), ("Shutdown", 'announce_stop'), ("Errors", 'announce_errors'))
+        if getattr(settings, column)
+    ) or "None", inline=False)
 
     await ctx.send(embed=embed)
     await ctx.send("To change a setting, use `=toggle <feature>` or `=setchannel <channel>`")
 
-    session.close()
-
 @bot.command()
 @commands.has_permissions(administrator=True)
 async def toggle(ctx, feature: str):
-    session = Session()
-    settings = session.query(ServerSettings).filter_by(server_id=str(ctx.guild.id)).first()
+    feature = feature.lower()
+    column = TOGGLE_FEATURES.get(feature)
+    settings = cache_settings(await run_db(toggle_setting, str(ctx.guild.id), column))
     
     if not settings:
         await ctx.send("This server hasn't been set up yet. Use `=setup` to configure the bot.")
         return
 
-    feature = feature.lower()
-    if feature == "status":
-        settings.track_status = not settings.track_status
-        state = "enabled" if settings.track_status else "disabled"
-    elif feature == "games":
-        settings.track_games = not settings.track_games
-        state = "enabled" if settings.track_games else "disabled"
-    elif feature == "voice":
-        settings.track_voice = not settings.track_voice
-        state = "enabled" if settings.track_voice else "disabled"
-    elif feature == "badges":
-        settings.use_badges = not settings.use_badges
-        state = "enabled" if settings.use_badges else "disabled"
-        if settings.use_badges:
-            await create_badge_roles(ctx.guild)
-    else:
-        await ctx.send("Invalid feature. Choose from: status, games, voice, badges")
+    if not column:
+        await ctx.send("Invalid feature. Choose from: status, games, voice, voicestates, badges, startup, shutdown, errors")
         return
 
-    session.commit()
-    await ctx.send(f"{feature.capitalize()} tracking has been {state}.")
-    session.close()
+    invalidate_results(str(ctx.guild.id))
+    state = "enabled" if getattr(settings, column) else "disabled"
+    if feature == "badges" and settings.use_badges:
+        badge_forbidden.discard(ctx.guild.id)
+        await create_badge_roles(ctx)
+
+    if column.startswith('announce_'):
+        await ctx.send(f"{feature.capitalize()} announcements have been {state}.")
+    else:
+        await ctx.send(f"{feature.capitalize()} tracking has been {state}.")
 
 @bot.command()
 @commands.has_permissions(administrator=True)
 async def setchannel(ctx, channel: discord.TextChannel):
-    session = Session()
-    settings = session.query(ServerSettings).filter_by(server_id=str(ctx.guild.id)).first()
+    settings = cache_settings(await run_db(set_notification_channel, str(ctx.guild.id), str(channel.id)))
     
     if not settings:
         await ctx.send("This server hasn't been set up yet. Use `=setup` to configure the bot.")
         return
 
-    settings.notification_channel_id = str(channel.id)
-    session.commit()
     await ctx.send(f"Notification channel has been set to {channel.mention}")
-    session.close()
+
+@bot.command()
+@commands.has_permissions(administrator=True)
+async def export(ctx, fmt: str = 'csv'):
+    fmt = fmt.lower()
+    if fmt not in EXPORT_FORMATS:
+        await ctx.send("Invalid format. Choose from: csv, ndjson")
+        return
+
+    await ctx.send("Exporting this server's activity history...")
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    path = os.path.join(EXPORT_DIR, f"{ctx.guild.id}-{datetime.utcnow():%Y%m%d-%H%M%S}.{fmt}.gz")
+    loop = asyncio.get_running_loop()
+    exported = await loop.run_in_executor(db_readers, export_intervals, path, fmt, str(ctx.guild.id))
+
+    # Only files too large to upload are left for the bot's host to hand over
+    if os.path.getsize(path) > ctx.guild.filesize_limit:
+        await ctx.send(f"Exported {exported} intervals to `{path}`, which is too large to upload here.")
+        return
+    try:
+        await ctx.send(f"Exported {exported} intervals.", file=discord.File(path))
+    finally:
+        os.remove(path)
 
 async def ask_yes_no(ctx, question):
     await ctx.send(question + " (yes/no)")
@@ -390,35 +2070,330 @@ async def ask_channel(ctx, question):
         await ctx.send("No response received. Skipping channel setup.")
         return None
 
-async def create_badge_roles(guild):
-    for badge_type in BADGES.values():
-        for role_name in badge_type.values():
-            if not discord.utils.get(guild.roles, name=role_name):
-                await guild.create_role(name=role_name)
-    await guild.owner.send("Badge roles have been created for your server.")
+async def create_badge_roles(ctx):
+    guild = ctx.guild
+    try:
+        for badge_name, tiers in BADGES.items():
+            for badge_tier in tiers:
+                await get_badge_role(guild, badge_name, badge_tier)
+    except discord.Forbidden:
+        await ctx.send("I need the Manage Roles permission to create badge roles.")
+        return
+
+    # The member cache is off, so guild.owner is usually None
+    try:
+        owner = guild.owner or await guild.fetch_member(guild.owner_id)
+        await owner.send("Badge roles have been created for your server.")
+    except discord.HTTPException:
+        await ctx.send("Badge roles have been created for this server.")
+
+# Command windows: days covered, or None for all time, and how they're described
+WINDOWS = {
+    'day': (1, "today"),
+    'week': (7, "the past week"),
+    'month': (30, "the past month"),
+    'all': (None, "all time"),
+}
+
+def window_start(days, now):
+    # Rollups are kept per day, so windows cover whole days up to and including today
+    if days is None:
+        return None
+    return datetime(now.year, now.month, now.day) - timedelta(days=days - 1)
+
+def window_days(since_day):
+    # Listing the days keeps SQLite on the covering index for both guild-wide and
+    # single user lookups
+    return [since_day + timedelta(days=i) for i in range((datetime.utcnow().date() - since_day).days + 1)]
+
+def rollup_totals(session, guild_id, kind, since_day, user_id=None):
+    query = session.query(ActivityRollup.user_id, ActivityRollup.key, func.sum(ActivityRollup.seconds)).filter(
+        ActivityRollup.guild_id == guild_id,
+        ActivityRollup.kind == kind
+    )
+    if since_day:
+        query = query.filter(ActivityRollup.day.in_(window_days(since_day)))
+    if user_id:
+        query = query.filter(ActivityRollup.user_id == user_id)
+    return query.group_by(ActivityRollup.user_id, ActivityRollup.key).all()
+
+def live_totals(guild_id, kind, since, now, user_id=None):
+    # Still-open intervals aren't in the rollups yet
+    if user_id:
+        keys = [(guild_id, user_id, kind)]
+    else:
+        keys = [key for key in guild_interval_keys.get(guild_id, ()) if key[2] == kind]
+
+    rows = []
+    for key in keys:
+        for value, start_time in open_intervals.get(key, {}).items():
+            start_time = max(start_time, since) if since else start_time
+            rows.append((key[1], value, (now - start_time).total_seconds()))
+    return rows
+
+async def fetch_totals(guild_id, kind, days, user_id=None):
+    now = datetime.utcnow()
+    since = window_start(days, now)
+    rows = await run_db(rollup_totals, guild_id, kind, since.date() if since else None, user_id)
+    return rows + live_totals(guild_id, kind, since, now, user_id)
+
+EPOCH = datetime(1970, 1, 1)
+
+def epoch_seconds(time):
+    return (time - EPOCH).total_seconds()
+
+# Per guild, category and window ranking kept up to date as interval changes are
+# written, so pages and rank lookups never re-aggregate the window. Users with
+# nothing open rank by their closed total. Users with one counted interval open
+# rank by start - closed, which orders them the same at any moment; their score
+# at now is closed + now - start. Users with several open, like two games at
+# once, gain faster than that and are scored on each lookup; there are few.
+class RankedIndex:
+    def __init__(self, since, day, built):
+        self.since = since
+        self.day = day
+        self.built = built
+        self.closed = {}
+        self.open_starts = {}
+        self.ranks = []
+        self.live = []
+        self.overlapping = set()
+
+    def entry(self, user_id):
+        starts = self.open_starts.get(user_id, ())
+        if not starts:
+            return self.ranks, (-self.closed.get(user_id, 0), user_id)
+        if len(starts) == 1:
+            return self.live, (starts[0] - self.closed.get(user_id, 0), user_id)
+        return None, None
+
+    def build(self):
+        self.ranks = sorted((-seconds, user_id) for user_id, seconds in self.closed.items() if seconds and user_id not in self.open_starts)
+        self.live = sorted((starts[0] - self.closed.get(user_id, 0), user_id) for user_id, starts in self.open_starts.items() if len(starts) == 1)
+        self.overlapping = {user_id for user_id, starts in self.open_starts.items() if len(starts) > 1}
+
+    def apply(self, user_id, seconds, closed_start, open_start):
+        entries, entry = self.entry(user_id)
+        if entries is None:
+            self.overlapping.discard(user_id)
+        else:
+            i = bisect_left(entries, entry)
+            if i < len(entries) and entries[i] == entry:
+                del entries[i]
+
+        self.closed[user_id] = self.closed.get(user_id, 0) + seconds
+        starts = self.open_starts.pop(user_id, [])
+        if closed_start in starts:
+            starts.remove(closed_start)
+        if open_start is not None:
+            starts.append(open_start)
+        if starts:
+            self.open_starts[user_id] = starts
+
+        if len(starts) > 1:
+            self.overlapping.add(user_id)
+        elif starts or self.closed[user_id]:
+            entries, entry = self.entry(user_id)
+            insort(entries, entry)
+
+    def __len__(self):
+        return len(self.ranks) + len(self.live) + len(self.overlapping)
+
+    def score(self, user_id, now):
+        return self.closed.get(user_id, 0) + sum(now - start for start in self.open_starts.get(user_id, ()))
+
+    def ahead(self, score, user_id, now):
+        # Users in ranks and live placed before this score
+        return bisect_left(self.ranks, (-score, user_id)) + bisect_left(self.live, (now - score, user_id))
+
+    def base_page(self, offset, limit, now):
+        # Both lists are sorted by -score once live entries are shifted by now, so
+        # the page start in each is found by binary search rather than a merge
+        ranks, live = self.ranks, self.live
+
+        def live_entry(j):
+            return live[j][0] - now, live[j][1]
+
+        lo, hi = max(0, offset - len(live)), min(offset, len(ranks))
+        while lo < hi:
+            i = (lo + hi) // 2
+            if ranks[i] < live_entry(offset - i - 1):
+                lo = i + 1
+            else:
+                hi = i
+
+        i, j = lo, offset - lo
+        rows = []
+        while len(rows) < limit and (i < len(ranks) or j < len(live)):
+            if j >= len(live) or (i < len(ranks) and ranks[i] < live_entry(j)):
+                rows.append((ranks[i][1], -ranks[i][0]))
+                i += 1
+            else:
+                key, user_id = live_entry(j)
+                rows.append((user_id, -key))
+                j += 1
+        return rows
+
+    def page(self, offset, limit, now):
+        now = epoch_seconds(now)
+        if not self.overlapping:
+            return self.base_page(offset, limit, now)
+
+        # Overlapping users are placed among a base page widened by their number
+        overlapping = sorted((-self.score(user_id, now), user_id) for user_id in self.overlapping)
+        start = max(offset - len(overlapping), 0)
+        rows = [
+            (position + bisect_left(overlapping, (-score, user_id)), user_id, score)
+            for position, (user_id, score) in enumerate(self.base_page(start, offset + limit - start, now), start)
+        ]
+        rows.extend((self.ahead(-key, user_id, now) + i, user_id, -key) for i, (key, user_id) in enumerate(overlapping))
+        return [(user_id, score) for position, user_id, score in sorted(rows) if offset <= position < offset + limit]
+
+    def rank(self, user_id, now):
+        if user_id not in self.open_starts and not self.closed.get(user_id):
+            return None
+        now = epoch_seconds(now)
+        score = self.score(user_id, now)
+        overlapping = sum(1 for other in self.overlapping if (-self.score(other, now), other) < (-score, user_id))
+        return self.ahead(score, user_id, now) + overlapping + 1
+
+RANKED_INDEX_LIMIT = int(os.getenv('TRACKMAN_RANKED_INDEX_LIMIT', 64))
+ranked_indexes = {}
+ranked_lru = OrderedDict()
+ranked_builds = {}
+ranked_pending = {}
+
+def build_ranked_index(session, guild_id, category, days, now):
+    kind, _ = LEADERBOARD_CATEGORIES[category]
+    table = TRACKED_KINDS[kind][0].__table__
+    since = window_start(days, now)
+    index = RankedIndex(since, now.date(), batches_written)
+
+    for user_id, key, seconds in rollup_totals(session, guild_id, kind, since.date() if since else None):
+        if user_id != str(TRACKMAN_ID) and counts_towards(category, key):
+            index.closed[user_id] = index.closed.get(user_id, 0) + seconds
+    for user_id, value, start_time in session.execute(select_intervals(kind, 'user_id', 'value', 'start_time').where(
+        table.c.guild_id == guild_id,
+        table.c.end_time == None
+    )):
+        if user_id != str(TRACKMAN_ID) and counts_towards(category, value):
+            index.open_starts.setdefault(user_id, []).append(epoch_seconds(max(start_time, since) if since else start_time))
+    index.build()
+    return index
+
+async def ranked_index(guild_id, category, days):
+    now = datetime.utcnow()
+    key = (guild_id, category, days)
+    index = ranked_indexes.get(guild_id, {}).get((category, days))
+    # Windowed rankings move with the day and are rebuilt after midnight
+    if index and (days is None or index.day == now.date()):
+        ranked_lru.move_to_end(key)
+        return index
+
+    build = ranked_builds.get(key)
+    if build is None:
+        build = ranked_builds[key] = asyncio.ensure_future(load_ranked_index(guild_id, category, days, now))
+        build.add_done_callback(lambda _: ranked_builds.pop(key, None))
+    return await asyncio.shield(build)
+
+async def load_ranked_index(guild_id, category, days, now):
+    # Batches written while this builds are held back until it's done, and
+    # applied unless the build already saw them
+    key = (guild_id, category, days)
+    ranked_pending[key] = []
+    try:
+        index = await run_db(build_ranked_index, guild_id, category, days, now, write=True)
+    finally:
+        pending = ranked_pending.pop(key)
+    for sequence, changes in pending:
+        if sequence > index.built:
+            for change in changes:
+                apply_ranking(index, category, change)
+
+    ranked_indexes.setdefault(guild_id, {})[(category, days)] = index
+    ranked_lru[key] = True
+    ranked_lru.move_to_end(key)
+    while len(ranked_lru) > RANKED_INDEX_LIMIT:
+        old_guild, old_category, old_days = ranked_lru.popitem(last=False)[0]
+        ranked_indexes[old_guild].pop((old_category, old_days), None)
+    return index
+
+def apply_ranking(index, category, change):
+    if LEADERBOARD_CATEGORIES[category][0] != change.kind or change.user_id == str(TRACKMAN_ID):
+        return
+
+    seconds, closed_start = 0, None
+    if change.closed_start and counts_towards(category, change.closed_value):
+        start_time = max(change.closed_start, index.since) if index.since else change.closed_start
+        seconds = max((change.time - start_time).total_seconds(), 0)
+        closed_start = epoch_seconds(start_time)
+    open_start = None
+    if change.value is not None and counts_towards(category, change.value):
+        open_start = epoch_seconds(max(change.time, index.since) if index.since else change.time)
+    index.apply(change.user_id, seconds, closed_start, open_start)
+
+def update_rankings(changes, sequence):
+    for (guild_id, category, days), pending in ranked_pending.items():
+        guild_changes = [change for change in changes if change.guild_id == guild_id]
+        if guild_changes:
+            pending.append((sequence, guild_changes))
+    for change in changes:
+        for (category, days), index in ranked_indexes.get(change.guild_id, {}).items():
+            apply_ranking(index, category, change)
+
+# Guild-wide command results are cached for a short while, so a spammed command
+# reuses the rendered embed fields and concurrent misses share one query
+RESULT_CACHE_TTL = float(os.getenv('TRACKMAN_RESULT_CACHE_TTL', 60))
+RESULT_CACHE_SIZE = int(os.getenv('TRACKMAN_RESULT_CACHE_SIZE', 1000))
+result_cache = OrderedDict()
+result_loads = {}
+
+async def load_result(key, compute):
+    try:
+        result = await compute()
+        result_cache[key] = (asyncio.get_running_loop().time() + RESULT_CACHE_TTL, result)
+        result_cache.move_to_end(key)
+        while len(result_cache) > RESULT_CACHE_SIZE:
+            result_cache.popitem(last=False)
+        return result
+    finally:
+        result_loads.pop(key, None)
+
+async def cached_result(key, compute):
+    entry = result_cache.get(key)
+    if entry and entry[0] > asyncio.get_running_loop().time():
+        result_cache.move_to_end(key)
+        return entry[1]
+
+    load = result_loads.get(key)
+    if load is None:
+        load = result_loads[key] = asyncio.ensure_future(load_result(key, compute))
+    return await asyncio.shield(load)
+
+def invalidate_results(guild_id):
+    for key in [key for key in result_cache if key[0] == guild_id]:
+        del result_cache[key]
 
 @bot.command()
-async def status(ctx, member: discord.Member = None):
+async def status(ctx, member: Optional[discord.Member] = None, window: str = 'week'):
     if ctx.author.id == TRACKMAN_ID:
         await ctx.send("Hey now, you can't stalk the stalker, go run away :)")
         return
+
+    if window not in WINDOWS:
+        await ctx.send("Invalid window. Choose 'day', 'week', 'month', or 'all'.")
+        return
     
     member = member or ctx.author
-    session = Session()
-    week_ago = datetime.utcnow() - timedelta(days=7)
-    activities = session.query(UserActivity).filter(
-        UserActivity.user_id == str(member.id),
-        UserActivity.start_time >= week_ago
-    ).all()
+    days, period = WINDOWS[window]
+    totals = await fetch_totals(str(ctx.guild.id), 'status', days, str(member.id))
     
     status_times = {'online': 0, 'idle': 0, 'dnd': 0, 'offline': 0}
-    for activity in activities:
-        end_time = activity.end_time or datetime.utcnow()
-        duration = (end_time - activity.start_time).total_seconds()
-        status_times[activity.status] += duration
+    for _, status, duration in totals:
+        status_times[status] = status_times.get(status, 0) + duration
     
     embed = discord.Embed(title=f"{member.name}'s Activity", 
-                          description="Activity breakdown for the past week",
+                          description=f"Activity breakdown for {period}",
                           color=discord.Color.blue())
     
     embed.set_thumbnail(url=member.avatar.url if member.avatar else member.default_avatar.url)
@@ -434,30 +2409,27 @@ async def status(ctx, member: discord.Member = None):
                      icon_url=ctx.author.avatar.url if ctx.author.avatar else ctx.author.default_avatar.url)
     
     await ctx.send(embed=embed)
-    session.close()
 
 @bot.command()
-async def gametime(ctx, member: discord.Member = None):
+async def gametime(ctx, member: Optional[discord.Member] = None, window: str = 'week'):
     if ctx.author.id == TRACKMAN_ID:
         await ctx.send("Hey now, you can't stalk the stalker, go run away :)")
         return
+
+    if window not in WINDOWS:
+        await ctx.send("Invalid window. Choose 'day', 'week', 'month', or 'all'.")
+        return
     
     member = member or ctx.author
-    session = Session()
-    week_ago = datetime.utcnow() - timedelta(days=7)
-    game_activities = session.query(GameActivity).filter(
-        GameActivity.user_id == str(member.id),
-        GameActivity.start_time >= week_ago
-    ).all()
+    days, period = WINDOWS[window]
+    totals = await fetch_totals(str(ctx.guild.id), 'game', days, str(member.id))
     
     game_times = {}
-    for activity in game_activities:
-        end_time = activity.end_time or datetime.utcnow()
-        duration = (end_time - activity.start_time).total_seconds()
-        game_times[activity.game] = game_times.get(activity.game, 0) + duration
+    for _, game, duration in totals:
+        game_times[game] = game_times.get(game, 0) + duration
     
     embed = discord.Embed(title=f"{member.name}'s Game Activity", 
-                          description="Game time breakdown for the past week",
+                          description=f"Game time breakdown for {period}",
                           color=discord.Color.green())
     
     embed.set_thumbnail(url=member.avatar.url if member.avatar else member.default_avatar.url)
@@ -473,132 +2445,152 @@ async def gametime(ctx, member: discord.Member = None):
                      icon_url=ctx.author.avatar.url if ctx.author.avatar else ctx.author.default_avatar.url)
     
     await ctx.send(embed=embed)
-    session.close()
+
+VOICETIME_CHANNELS = 20
 
 @bot.command()
-async def voicetime(ctx, member: discord.Member = None):
+async def voicetime(ctx, member: Optional[discord.Member] = None, window: str = 'week'):
     if ctx.author.id == TRACKMAN_ID:
         await ctx.send("Hey now, you can't stalk the stalker, go run away :)")
         return
+
+    if window not in WINDOWS:
+        await ctx.send("Invalid window. Choose 'day', 'week', 'month', or 'all'.")
+        return
     
     member = member or ctx.author
-    session = Session()
-    week_ago = datetime.utcnow() - timedelta(days=7)
-    voice_activities = session.query(VoiceActivity).filter(
-        VoiceActivity.user_id == str(member.id),
-        VoiceActivity.start_time >= week_ago
-    ).all()
-    
-    total_time = 0
-    for activity in voice_activities:
-        end_time = activity.end_time or datetime.utcnow()
-        duration = (end_time - activity.start_time).total_seconds()
-        total_time += duration
+    days, period = WINDOWS[window]
+    totals = await fetch_totals(str(ctx.guild.id), 'voice', days, str(member.id))
+    
+    channel_times = {}
+    for _, channel_id, duration in totals:
+        channel_times[channel_id] = channel_times.get(channel_id, 0) + duration
+    total_time = sum(channel_times.values())
     
     hours = total_time // 3600
     minutes = (total_time % 3600) // 60
     
     embed = discord.Embed(title=f"{member.name}'s Voice Activity", 
-                          description="Voice channel time for the past week",
+                          description=f"Voice channel time for {period}",
                           color=discord.Color.purple())
     
     embed.set_thumbnail(url=member.avatar.url if member.avatar else member.default_avatar.url)
     embed.add_field(name="Total Time", value=f"{hours:.0f} hours, {minutes:.0f} minutes", inline=False)
     
+    settings = get_settings(str(ctx.guild.id))
+    if settings and settings.track_voice_states:
+        state_times = {}
+        for _, state, duration in await fetch_totals(str(ctx.guild.id), 'voice_state', days, str(member.id)):
+            state_times[state] = state_times.get(state, 0) + duration
+        embed.add_field(name="Voice States", value="\n".join(
+            f"{state.capitalize()}: {state_times[state] // 3600:.0f} hours, {state_times[state] % 3600 // 60:.0f} minutes"
+            for state in VOICE_STATES if state in state_times
+        ) or "None", inline=False)
+    
+    # Embeds hold at most 25 fields
+    for channel_id, time in sorted(channel_times.items(), key=lambda x: x[1], reverse=True)[:VOICETIME_CHANNELS]:
+        channel = ctx.guild.get_channel(int(channel_id))
+        hours = time // 3600
+        minutes = (time % 3600) // 60
+        embed.add_field(name=f"#{channel.name}" if channel else "Deleted channel", 
+                        value=f"{hours:.0f} hours, {minutes:.0f} minutes",
+                        inline=False)
+    
     embed.set_footer(text=f"Requested by {ctx.author.name}", 
                      icon_url=ctx.author.avatar.url if ctx.author.avatar else ctx.author.default_avatar.url)
     
     await ctx.send(embed=embed)
-    session.close()
+
+LEADERBOARD_PAGE_SIZE = 10
+
+async def leaderboard_fields(guild, category, days, page):
+    index = await ranked_index(str(guild.id), category, days)
+    offset = (page - 1) * LEADERBOARD_PAGE_SIZE
+    rows = index.page(offset, LEADERBOARD_PAGE_SIZE, datetime.utcnow())
+    users = {str(member.id): member for member in await fetch_members(guild, [int(user_id) for user_id, _ in rows])}
+    fields = []
+    for i, (user_id, time) in enumerate(rows, offset + 1):
+        user = users.get(user_id)
+        if user:
+            hours = time // 3600
+            minutes = (time % 3600) // 60
+            fields.append((f"{i}. {user.name}", f"{hours:.0f} hours, {minutes:.0f} minutes"))
+    return fields, max(-(-len(index) // LEADERBOARD_PAGE_SIZE), 1)
 
 @bot.command()
-async def leaderboard(ctx, category: str):
-    session = Session()
-    week_ago = datetime.utcnow() - timedelta(days=7)
-    
-    if category == 'online':
-        query = session.query(
-            UserActivity.user_id,
-            func.sum(func.julianday(func.coalesce(UserActivity.end_time, func.current_timestamp())) - func.julianday(UserActivity.start_time)) * 24 * 60 * 60
-        ).filter(
-            UserActivity.start_time >= week_ago,
-            UserActivity.status == 'online',
-            UserActivity.user_id != str(TRACKMAN_ID)
-        ).group_by(UserActivity.user_id).order_by(func.sum(func.julianday(func.coalesce(UserActivity.end_time, func.current_timestamp())) - func.julianday(UserActivity.start_time)).desc()).limit(5)
-        
-        title = "Online Time Leaderboard"
-        
-    elif category == 'games':
-        query = session.query(
-            GameActivity.user_id,
-            func.sum(func.julianday(func.coalesce(GameActivity.end_time, func.current_timestamp())) - func.julianday(GameActivity.start_time)) * 24 * 60 * 60
-        ).filter(
-            GameActivity.start_time >= week_ago,
-            GameActivity.user_id != str(TRACKMAN_ID),
-            GameActivity.game != "Stalking Simulator"
-        ).group_by(GameActivity.user_id).order_by(func.sum(func.julianday(func.coalesce(GameActivity.end_time, func.current_timestamp())) - func.julianday(GameActivity.start_time)).desc()).limit(5)
-        
-        title = "Gaming Time Leaderboard"
-        
-    elif category == 'voice':
-        query = session.query(
-            VoiceActivity.user_id,
-            func.sum(func.julianday(func.coalesce(VoiceActivity.end_time, func.current_timestamp())) - func.julianday(VoiceActivity.start_time)) * 24 * 60 * 60
-        ).filter(
-            VoiceActivity.start_time >= week_ago,
-            VoiceActivity.user_id != str(TRACKMAN_ID)
-        ).group_by(VoiceActivity.user_id).order_by(func.sum(func.julianday(func.coalesce(VoiceActivity.end_time, func.current_timestamp())) - func.julianday(VoiceActivity.start_time)).desc()).limit(5)
-        
-        title = "Voice Channel Time Leaderboard"
-    
-    else:
+async def leaderboard(ctx, category: str, window: str = 'week', page: int = 1):
+    if category not in LEADERBOARD_CATEGORIES:
         await ctx.send("Invalid category. Choose 'online', 'games', or 'voice'.")
         return
+
+    if window not in WINDOWS:
+        await ctx.send("Invalid window. Choose 'day', 'week', 'month', or 'all'.")
+        return
+
+    guild_id = str(ctx.guild.id)
+    days, period = WINDOWS[window]
+    page = max(page, 1)
+    _, title = LEADERBOARD_CATEGORIES[category]
+    fields, pages = await cached_result((guild_id, category, days, page), lambda: leaderboard_fields(ctx.guild, category, days, page))
+    rank = (await ranked_index(guild_id, category, days)).rank(str(ctx.author.id), datetime.utcnow())
     
-    results = query.all()
-    
+    description = f"Top users for {period} (page {page} of {pages})"
+    if rank:
+        description += f"\nYour rank: #{rank}"
     embed = discord.Embed(title=title, 
-                          description="Top 5 users for the past week",
+                          description=description,
                           color=discord.Color.gold())
     
-    for i, (user_id, time) in enumerate(results, 1):
-        user = ctx.guild.get_member(int(user_id))
-        if user:
-            hours = time // 3600
-            minutes = (time % 3600) // 60
-            embed.add_field(name=f"{i}. {user.name}", 
-                            value=f"{hours:.0f} hours, {minutes:.0f} minutes",
-                            inline=False)
+    for name, value in fields:
+        embed.add_field(name=name, value=value, inline=False)
     
     embed.set_footer(text=f"Requested by {ctx.author.name}", 
                      icon_url=ctx.author.avatar.url if ctx.author.avatar else ctx.author.default_avatar.url)
     
     await ctx.send(embed=embed)
-    session.close()
 
-@bot.command()
-async def mostplayedgame(ctx):
-    session = Session()
-    week_ago = datetime.utcnow() - timedelta(days=7)
-    
-    query = session.query(
-        GameActivity.game,
-        func.sum(func.julianday(func.coalesce(GameActivity.end_time, func.current_timestamp())) - func.julianday(GameActivity.start_time)) * 24 * 60 * 60
-    ).filter(
-        GameActivity.start_time >= week_ago,
-        GameActivity.game != "Stalking Simulator"
-    ).group_by(GameActivity.game).order_by(func.sum(func.julianday(func.coalesce(GameActivity.end_time, func.current_timestamp())) - func.julianday(GameActivity.start_time)).desc()).first()
-    
-    if query:
-        game, time = query
+def key_totals(session, guild_id, kind, since_day):
+    # Summed per game or channel only, not per user as well
+    query = session.query(ActivityRollup.key, func.sum(ActivityRollup.seconds)).filter(
+        ActivityRollup.guild_id == guild_id,
+        ActivityRollup.kind == kind
+    )
+    if since_day:
+        query = query.filter(ActivityRollup.day.in_(window_days(since_day)))
+    return query.group_by(ActivityRollup.key).all()
+
+async def fetch_key_totals(guild_id, kind, days):
+    now = datetime.utcnow()
+    since = window_start(days, now)
+    totals = {}
+    rows = await run_db(key_totals, guild_id, kind, since.date() if since else None)
+    for key, seconds in rows + [(key, seconds) for _, key, seconds in live_totals(guild_id, kind, since, now)]:
+        totals[key] = totals.get(key, 0) + seconds
+    return totals
+
+def most_played_game(totals):
+    game_times = {game: duration for game, duration in totals.items() if counts_towards('games', game)}
+    return max(game_times.items(), key=lambda x: x[1], default=None)
+
+async def most_played_field(guild, days):
+    result = most_played_game(await fetch_key_totals(str(guild.id), 'game', days))
+    if result:
+        game, time = result
         hours = time // 3600
         minutes = (time % 3600) // 60
-        
+        return game, f"{hours:.0f} hours, {minutes:.0f} minutes"
+    return None
+
+@bot.command()
+async def mostplayedgame(ctx):
+    field = await cached_result((str(ctx.guild.id), 'mostplayedgame', 7), lambda: most_played_field(ctx.guild, 7))
+    
+    if field:
         embed = discord.Embed(title="Most Played Game", 
                               description=f"For the past week",
                               color=discord.Color.orange())
         
-        embed.add_field(name=game, value=f"{hours:.0f} hours, {minutes:.0f} minutes", inline=False)
+        embed.add_field(name=field[0], value=field[1], inline=False)
         
         embed.set_footer(text=f"Requested by {ctx.author.name}", 
                          icon_url=ctx.author.avatar.url if ctx.author.avatar else ctx.author.default_avatar.url)
@@ -606,8 +2598,457 @@ async def mostplayedgame(ctx):
         await ctx.send(embed=embed)
     else:
         await ctx.send("No game activity recorded in the past week.")
+
+CHANNEL_LEADERBOARD_SIZE = 10
+
+async def channel_leaderboard_fields(guild, days):
+    totals = await fetch_key_totals(str(guild.id), 'voice', days)
+    fields = []
+    for channel_id, time in sorted(totals.items(), key=lambda x: x[1], reverse=True):
+        channel = guild.get_channel(int(channel_id))
+        if channel:
+            hours = time // 3600
+            minutes = (time % 3600) // 60
+            fields.append((f"{len(fields) + 1}. #{channel.name}", f"{hours:.0f} hours, {minutes:.0f} minutes"))
+            if len(fields) == CHANNEL_LEADERBOARD_SIZE:
+                break
+    return fields
+
+@bot.command()
+async def channels(ctx, window: str = 'week'):
+    if window not in WINDOWS:
+        await ctx.send("Invalid window. Choose 'day', 'week', 'month', or 'all'.")
+        return
+
+    days, period = WINDOWS[window]
+    fields = await cached_result((str(ctx.guild.id), 'channels', days), lambda: channel_leaderboard_fields(ctx.guild, days))
+
+    if not fields:
+        await ctx.send(f"No voice activity recorded for {period}.")
+        return
+
+    embed = discord.Embed(title="Voice Channel Leaderboard", 
+                          description=f"Most used voice channels for {period}",
+                          color=discord.Color.purple())
+    
+    for name, value in fields:
+        embed.add_field(name=name, value=value, inline=False)
+    
+    embed.set_footer(text=f"Requested by {ctx.author.name}", 
+                     icon_url=ctx.author.avatar.url if ctx.author.avatar else ctx.author.default_avatar.url)
+    
+    await ctx.send(embed=embed)
+
+# Server insights over the past four weeks: average members active in each hour
+# of the week, members active each day, and this week against the last. The
+# writer keeps hourly totals and each day's active members in the database, so
+# a guild's index is built from a few hundred rows once a day; batches written
+# after that are folded in, and open intervals are added at lookup.
+INSIGHTS_DAYS = 28
+INSIGHTS_LIMIT = int(os.getenv('TRACKMAN_INSIGHTS_LIMIT', 64))
+HEATMAP_SHADES = " ░▒▓█"
+WEEKDAYS = ("Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun")
+insights_indexes = OrderedDict()
+insights_builds = {}
+insights_pending = {}
+
+def elapsed(points, bounds):
+    # Sum over sorted points below each bound of bound - point
+    below = np.searchsorted(points, bounds)
+    return below * bounds - np.concatenate(([0.0], np.cumsum(points)))[below]
+
+def bin_intervals(since, starts, ends):
+    # Seconds active in each hour of the window, with times in epoch seconds
+    starts = np.maximum(starts - since, 0)
+    ends = np.minimum(ends - since, INSIGHTS_DAYS * 86400)
+    kept = ends > starts
+    bounds = 3600.0 * np.arange(INSIGHTS_DAYS * 24 + 1)
+    return np.diff(elapsed(np.sort(starts[kept]), bounds) - elapsed(np.sort(ends[kept]), bounds))
+
+class Insights:
+    def __init__(self, since, built, day):
+        # built is the last write batch the build saw
+        self.since = since
+        self.built = built
+        self.day = day
+        self.hours = {}
+        self.daily = {}
+
+    def add(self, category, starts, ends):
+        self.hours[category] += bin_intervals(self.since, starts, ends)
+
+    def mark(self, category, days):
+        self.daily[category] += np.bincount(days, minlength=INSIGHTS_DAYS)
+
+    def totals(self, category, starts, ends):
+        # Hourly seconds and daily active members with the given open intervals,
+        # whose members were marked active when they opened or at the build
+        return self.hours[category] + bin_intervals(self.since, starts, ends), self.daily[category]
+
+def interval_arrays(intervals):
+    # (start, end) tuples to float epoch seconds
+    if not intervals:
+        return np.zeros(0), np.zeros(0)
+    starts, ends = zip(*intervals)
+    return np.array(starts, dtype=float), np.array(ends, dtype=float)
+
+def build_insights(session, guild_id, now, opened):
+    # Runs on the writer thread, between batches. Members of the intervals open
+    # now are marked active on each day they span first.
+    since = window_start(INSIGHTS_DAYS, now)
+    members = set()
+    for user_id, kind, key, start_time in opened:
+        category = insights_category(kind, key)
+        if category:
+            members.update((guild_id, category, day, user_id) for day, _ in split_by_day(max(start_time, since), now))
+    write_insights(session, {}, members)
+    session.commit()
+
+    insights = Insights(epoch_seconds(since), batches_written, now.date())
+    hourly, active = ActivityHourly.__table__, ActiveMember.__table__
+    for category in LEADERBOARD_CATEGORIES:
+        insights.hours[category] = np.zeros(INSIGHTS_DAYS * 24)
+        for hour, seconds in session.execute(select(hourly.c.hour, hourly.c.seconds).where(
+            hourly.c.guild_id == guild_id,
+            hourly.c.category == category,
+            hourly.c.hour >= since,
+            hourly.c.hour < since + timedelta(days=INSIGHTS_DAYS)
+        )):
+            insights.hours[category][int((hour - since).total_seconds()) // 3600] = seconds
+
+        insights.daily[category] = np.zeros(INSIGHTS_DAYS, dtype=np.int64)
+        for day, count in session.execute(select(active.c.day, func.count()).where(
+            active.c.guild_id == guild_id,
+            active.c.category == category,
+            active.c.day >= since.date(),
+            active.c.user_id != str(TRACKMAN_ID)
+        ).group_by(active.c.day)):
+            insights.daily[category][(day - since.date()).days] = count
+    return insights
+
+def open_guild_intervals(guild_id):
+    return [
+        (user_id, kind, value, start_time)
+        for _, user_id, kind in guild_interval_keys.get(guild_id, ())
+        if user_id != str(TRACKMAN_ID)
+        for value, start_time in open_intervals[(guild_id, user_id, kind)].items()
+    ]
+
+async def load_insights(guild_id):
+    # Batches written while this builds are held back until it's done, and
+    # folded in unless the build already saw them
+    insights_pending[guild_id] = []
+    try:
+        insights = await run_db(build_insights, guild_id, datetime.utcnow(), open_guild_intervals(guild_id), write=True)
+    finally:
+        pending = insights_pending.pop(guild_id)
+    for sequence, changes, marked in pending:
+        if sequence > insights.built:
+            fold_batch(insights, changes, marked)
+    insights_indexes[guild_id] = insights
+    insights_indexes.move_to_end(guild_id)
+    while len(insights_indexes) > INSIGHTS_LIMIT:
+        insights_indexes.popitem(last=False)
+    return insights
+
+async def guild_insights(guild_id):
+    insights = insights_indexes.get(guild_id)
+    # The window moves with the day, so the index is rebuilt after midnight
+    if insights and insights.day == datetime.utcnow().date():
+        insights_indexes.move_to_end(guild_id)
+        return insights
+
+    build = insights_builds.get(guild_id)
+    if build is None:
+        build = insights_builds[guild_id] = asyncio.ensure_future(load_insights(guild_id))
+        build.add_done_callback(lambda _: insights_builds.pop(guild_id, None))
+    return await asyncio.shield(build)
+
+def fold_batch(insights, changes, marked):
+    closed = {}
+    for change in changes:
+        category = change.closed_start and insights_category(change.kind, change.closed_value)
+        if category and change.user_id != str(TRACKMAN_ID):
+            closed.setdefault(category, []).append((epoch_seconds(change.closed_start), epoch_seconds(change.time)))
+    for category, intervals in closed.items():
+        insights.add(category, *interval_arrays(intervals))
+
+    since_day = (EPOCH + timedelta(seconds=insights.since)).date()
+    days = {}
+    for _, category, day, user_id in marked:
+        if user_id != str(TRACKMAN_ID) and 0 <= (day - since_day).days < INSIGHTS_DAYS:
+            days.setdefault(category, []).append((day - since_day).days)
+    for category, indexes in days.items():
+        insights.mark(category, np.array(indexes, dtype=np.int64))
+
+def update_insights(changes, sequence, marked):
+    batches = {}
+    for change in changes:
+        if change.guild_id in insights_pending or change.guild_id in insights_indexes:
+            batches.setdefault(change.guild_id, ([], []))[0].append(change)
+    for member in marked:
+        if member[0] in insights_pending or member[0] in insights_indexes:
+            batches.setdefault(member[0], ([], []))[1].append(member)
+    for guild_id, (guild_changes, guild_marked) in batches.items():
+        if guild_id in insights_pending:
+            insights_pending[guild_id].append((sequence, guild_changes, guild_marked))
+        else:
+            fold_batch(insights_indexes[guild_id], guild_changes, guild_marked)
+
+def open_category_intervals(guild_id, category, now):
+    kind, _ = LEADERBOARD_CATEGORIES[category]
+    return [
+        (epoch_seconds(start_time), epoch_seconds(now))
+        for _, user_id, key_kind in guild_interval_keys.get(guild_id, ())
+        if key_kind == kind and user_id != str(TRACKMAN_ID)
+        for value, start_time in open_intervals[(guild_id, user_id, kind)].items()
+        if counts_towards(category, value)
+    ]
+
+def format_change(current, previous):
+    if not previous:
+        return "new" if current else "no change"
+    return f"{(current - previous) / previous * 100:+.0f}%"
+
+def heatmap_lines(insights, hours, now):
+    # Average members active in each hour of the week, over the full hours so far
+    full_hours = int((epoch_seconds(now) - insights.since) // 3600)
+    slots = ((EPOCH + timedelta(seconds=insights.since)).weekday() * 24 + np.arange(full_hours)) % (7 * 24)
+    seen = np.bincount(slots, minlength=7 * 24)
+    average = np.bincount(slots, weights=hours[:full_hours] / 3600, minlength=7 * 24) / np.maximum(seen, 1)
+    peak = average.max()
+    levels = np.ceil(average / peak * (len(HEATMAP_SHADES) - 1)).astype(int) if peak else np.zeros(7 * 24, dtype=int)
+    lines = ["    0     6     12    18"]
+    for weekday, name in enumerate(WEEKDAYS):
+        lines.append(f"{name} " + "".join(HEATMAP_SHADES[level] for level in levels[weekday * 24:(weekday + 1) * 24]))
+    peak_slot = int(average.argmax())
+    return lines, f"Busiest: {WEEKDAYS[peak_slot // 24]} {peak_slot % 24:02d}:00 UTC, {peak:.1f} members on average"
+
+async def insights_fields(guild, category):
+    guild_id = str(guild.id)
+    insights = await guild_insights(guild_id)
+    now = datetime.utcnow()
+    current_hour = min(int((epoch_seconds(now) - insights.since) // 3600), INSIGHTS_DAYS * 24 - 1)
+
+    fields, trends = [], []
+    for name, (kind, _) in LEADERBOARD_CATEGORIES.items():
+        hours, daily = insights.totals(name, *interval_arrays(open_category_intervals(guild_id, name, now)))
+        this_week = hours[max(current_hour - 7 * 24 + 1, 0):current_hour + 1].sum() / 3600
+        last_week = hours[max(current_hour - 14 * 24 + 1, 0):max(current_hour - 7 * 24 + 1, 0)].sum() / 3600
+        trends.append(f"{name.capitalize()}: {this_week:.0f} hours ({format_change(this_week, last_week)})")
+        if name != category:
+            continue
+
+        lines, peak = heatmap_lines(insights, hours, now)
+        fields.append((f"Hourly Heatmap ({name.capitalize()})", "```\n" + "\n".join(lines) + "\n```\n" + peak))
+        today = INSIGHTS_DAYS - 1
+        fields.append(("Daily Active Members", "\n".join(
+            f"{(now - timedelta(days=today - day)):%a %d %b}: {daily[day]}" for day in range(today - 6, today + 1)
+        ) + f"\n4 week average: {daily.mean():.1f}"))
+    fields.append(("Week over Week", "\n".join(trends)))
+    return fields
+
+@bot.command()
+async def insights(ctx, category: str = 'online'):
+    if category not in LEADERBOARD_CATEGORIES:
+        await ctx.send("Invalid category. Choose 'online', 'games', or 'voice'.")
+        return
+
+    fields = await cached_result((str(ctx.guild.id), 'insights', category), lambda: insights_fields(ctx.guild, category))
+
+    embed = discord.Embed(title="Server Insights", 
+                          description="Activity over the past four weeks",
+                          color=discord.Color.teal())
     
-    session.close()
+    for name, value in fields:
+        embed.add_field(name=name, value=value, inline=False)
+    
+    embed.set_footer(text=f"Requested by {ctx.author.name}", 
+                     icon_url=ctx.author.avatar.url if ctx.author.avatar else ctx.author.default_avatar.url)
+    
+    await ctx.send(embed=embed)
+
+# Metrics endpoint, =perf and the sweep profiler. The endpoint is off unless
+# TRACKMAN_METRICS_PORT is set; each shard process needs its own port.
+METRICS_HOST = os.getenv('TRACKMAN_METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('TRACKMAN_METRICS_PORT', 0))
+LOOP_LAG_INTERVAL = 0.5
+PROFILE_DIR = os.getenv('TRACKMAN_PROFILE_DIR', 'profiles')
+PROFILE_INTERVAL = 0.005
+
+@bot.before_invoke
+async def start_command_timer(ctx):
+    ctx.started = perf_counter()
+
+@bot.after_invoke
+async def record_command_latency(ctx):
+    observe('trackman_command_seconds', perf_counter() - ctx.started, command=ctx.command.qualified_name)
+
+async def monitor_loop_lag():
+    # Anything hogging the event loop delays this wakeup by as long
+    loop = asyncio.get_running_loop()
+    while True:
+        expected = loop.time() + LOOP_LAG_INTERVAL
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        observe('trackman_event_loop_lag_seconds', max(loop.time() - expected, 0))
+
+def metric_gauges():
+    return {
+        'trackman_write_queue_depth': write_queue.qsize(),
+        'trackman_notification_queue_depth': notifications.qsize(),
+        'trackman_open_intervals': sum(len(intervals) for intervals in open_intervals.values()),
+        'trackman_tracked_members': sum(len(members) for members in member_states.values()),
+        'trackman_ranked_indexes': len(ranked_lru),
+        'trackman_result_cache_entries': len(result_cache),
+        'trackman_gateway_latency_seconds': bot.latency,
+    }
+
+def format_labels(labels):
+    return '{' + ','.join(f'{name}="{value}"' for name, value in labels) + '}' if labels else ''
+
+def render_metrics():
+    with metrics_lock:
+        snapshot = [(key, list(histogram.buckets), histogram.total, histogram.count) for key, histogram in histograms.items()]
+        counts = list(metric_counts.items())
+
+    lines = []
+    typed = set()
+    for (name, labels), buckets, total, observations in sorted(snapshot):
+        if name not in typed:
+            typed.add(name)
+            lines.append(f"# TYPE {name} histogram")
+        cumulative = 0
+        for bound, bucket in zip(METRIC_BUCKETS + ('+Inf',), buckets):
+            cumulative += bucket
+            lines.append(f"{name}_bucket{format_labels(labels + (('le', bound),))} {cumulative}")
+        lines.append(f"{name}_sum{format_labels(labels)} {total}")
+        lines.append(f"{name}_count{format_labels(labels)} {observations}")
+    for (name, labels), value in sorted(counts):
+        if name not in typed:
+            typed.add(name)
+            lines.append(f"# TYPE {name} counter")
+        lines.append(f"{name}{format_labels(labels)} {value}")
+    for name, value in metric_gauges().items():
+        lines.append(f"# TYPE {name} gauge")
+        lines.append(f"{name} {value}")
+    return '\n'.join(lines) + '\n'
+
+async def metrics_handler(request):
+    return web.Response(body=render_metrics().encode(), headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+async def serve_metrics():
+    app = web.Application()
+    app.router.add_get('/metrics', metrics_handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, METRICS_HOST, METRICS_PORT).start()
+    log.info("Serving metrics on http://%s:%d/metrics", METRICS_HOST, METRICS_PORT)
+
+# Samples every thread's stack while one sweep runs and its writes flush, and
+# writes them as folded stacks for flamegraph.pl or speedscope
+class StackSampler(threading.Thread):
+    def __init__(self):
+        super().__init__(name='trackman-profiler', daemon=True)
+        self.stacks = {}
+        self.samples = 0
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(PROFILE_INTERVAL):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == self.ident:
+                    continue
+                stack = []
+                while frame:
+                    stack.append(f"{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                key = ';'.join([names.get(thread_id, str(thread_id))] + stack[::-1])
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+            self.samples += 1
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+    def dump(self, path):
+        with open(path, 'w') as file:
+            for stack, samples in sorted(self.stacks.items()):
+                file.write(f"{stack} {samples}\n")
+
+async def profile_sweep():
+    sampler = StackSampler()
+    sampler.start()
+    try:
+        await reconcile_activities()
+        await flush_writes()
+    finally:
+        sampler.stop()
+
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    path = os.path.join(PROFILE_DIR, f"sweep-{datetime.utcnow():%Y%m%d-%H%M%S}.folded")
+    sampler.dump(path)
+    return path, sampler.samples
+
+def latency_summary(name):
+    with metrics_lock:
+        rows = [(dict(labels), histogram.count, histogram.percentile(0.5), histogram.percentile(0.99)) for (metric, labels), histogram in histograms.items() if metric == name]
+    return sorted(rows, key=lambda row: row[3], reverse=True)
+
+def format_latency(observations, p50, p99):
+    return f"p50 {p50 * 1000:.1f} ms, p99 {p99 * 1000:.1f} ms ({observations})"
+
+@bot.command()
+@commands.has_permissions(administrator=True)
+async def perf(ctx, action: Optional[str] = None):
+    if action == 'profile':
+        # A sweep covers every guild the bot is in, so only its owner may profile one
+        if not await bot.is_owner(ctx.author):
+            await ctx.send("Only the bot's owner can profile a sweep.")
+            return
+        await ctx.send("Profiling one sweep...")
+        path, samples = await profile_sweep()
+        if os.path.getsize(path) > ctx.guild.filesize_limit:
+            await ctx.send(f"Sweep profile written to `{path}` ({samples} samples), which is too large to upload here.")
+            return
+        try:
+            await ctx.send(f"Sweep profile of {samples} samples.", file=discord.File(path))
+        finally:
+            os.remove(path)
+        return
+    if action is not None:
+        await ctx.send("Invalid action. Use `=perf` or `=perf profile`.")
+        return
+
+    embed = discord.Embed(title="TrackMan Performance", color=discord.Color.blue())
+    for title, name, label in (
+        ("Sweeps", 'trackman_sweep_seconds', 'shard'),
+        ("Interval Writes", 'trackman_write_batch_seconds', None),
+        ("Queries", 'trackman_query_seconds', 'statement'),
+        ("Commands", 'trackman_command_seconds', 'command'),
+        ("Event Loop Lag", 'trackman_event_loop_lag_seconds', None),
+    ):
+        lines = [
+            (f"{labels[label]}: " if label else "") + format_latency(observations, p50, p99)
+            for labels, observations, p50, p99 in latency_summary(name)[:5]
+        ]
+        embed.add_field(name=title, value="\n".join(lines) or "No data yet", inline=False)
+
+    gauges = metric_gauges()
+    embed.add_field(name="Queues", value=(
+        f"Interval writes: {gauges['trackman_write_queue_depth']}\n"
+        f"Badge notifications: {gauges['trackman_notification_queue_depth']}"
+    ), inline=False)
+    with metrics_lock:
+        rate_limits = metric_counts.get(metric_key('trackman_rate_limits_total', {}), 0)
+        failures = metric_counts.get(metric_key('trackman_write_failures_total', {}), 0)
+        settings_hits = metric_counts.get(metric_key('trackman_settings_cache_total', {'result': 'hit'}), 0)
+        settings_misses = metric_counts.get(metric_key('trackman_settings_cache_total', {'result': 'miss'}), 0)
+    embed.add_field(name="Discord", value=f"Gateway latency: {bot.latency * 1000:.0f} ms\nRate limits hit: {rate_limits}", inline=False)
+    embed.add_field(name="Failed Writes", value=str(failures), inline=False)
+    embed.add_field(name="Settings Cache", value=f"{settings_hits} hits, {settings_misses} misses (unconfigured servers)", inline=False)
+
+    await ctx.send(embed=embed)
 
 @bot.command()
 async def ping(ctx):
@@ -624,17 +3065,21 @@ async def show_commands(ctx):
                           color=discord.Color.purple())
     
     commands_list = [
-        ("=status [@user]", "Shows a user's online activity breakdown"),
-        ("=gametime [@user]", "Shows a user's game activity"),
-        ("=voicetime [@user]", "Shows a user's voice channel activity"),
-        ("=leaderboard <category>", "Shows leaderboard for online, games, or voice"),
+        ("=status [@user] [window]", "Shows a user's online activity breakdown"),
+        ("=gametime [@user] [window]", "Shows a user's game activity"),
+        ("=voicetime [@user] [window]", "Shows a user's voice channel activity"),
+        ("=leaderboard <category> [window] [page]", "Shows leaderboard for online, games, or voice"),
+        ("=channels [window]", "Shows the most used voice channels on the server"),
         ("=mostplayedgame", "Shows the most played game on the server"),
+        ("=insights [category]", "Shows when the server is active, daily active members and weekly trends"),
         ("=ping", "Checks bot's latency"),
         ("=commands", "Displays this help message"),
         ("=setup", "Initial bot setup (admin only)"),
         ("=config", "View current bot configuration (admin only)"),
         ("=toggle <feature>", "Toggle a feature on/off (admin only)"),
-        ("=setchannel <channel>", "Set notification channel (admin only)")
+        ("=setchannel <channel>", "Set notification channel (admin only)"),
+        ("=export [csv|ndjson]", "Export this server's activity history (admin only)"),
+        ("=perf [profile]", "Show performance metrics, or profile one sweep (admin only)")
     ]
     
     for command, description in commands_list:
@@ -645,4 +3090,29 @@ async def show_commands(ctx):
     
     await ctx.send(embed=embed)
 
-bot.run(TOKEN)
\ No newline at end of file
+# Offline tooling against the configured database, safe to run next to the bot:
+#   python track.py export [--guild ID] [--format csv|ndjson] PATH
+#   python track.py import PATH
+def run_cli(argv):
+    parser = argparse.ArgumentParser(prog='track.py')
+    subcommands = parser.add_subparsers(dest='command', required=True)
+    export_parser = subcommands.add_parser('export', help="Write intervals to a gzipped CSV or NDJSON file")
+    export_parser.add_argument('--guild', help="Only this guild's intervals")
+    export_parser.add_argument('--format', choices=EXPORT_FORMATS, default='csv')
+    export_parser.add_argument('path')
+    import_parser = subcommands.add_parser('import', help="Add the closed intervals of an export to this database")
+    import_parser.add_argument('path')
+    args = parser.parse_args(argv)
+
+    if args.command == 'export':
+        print(f"Exported {export_intervals(args.path, args.format, args.guild)} intervals to {args.path}")
+    else:
+        imported, skipped = import_intervals(args.path)
+        print(f"Imported {imported} intervals, skipped {skipped} open or unplaced ones")
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        run_cli(sys.argv[1:])
+    else:
+        # discord.py only sets up its own logger unless asked for the root one
+        bot.run(TOKEN, root_logger=True)
\ No newline at end of file